@@ -1,7 +1,9 @@
+import time
+from functools import partial
 from tqdm import tqdm
 from argparse import ArgumentParser
 
-from config import conf
+from config import conf, add_conf_args, resolve_conf
 from utils import *
 
 import jax
@@ -10,18 +12,19 @@ import optax
 from flax import linen as nn
 from model import Net
 from flax.training import train_state
-from diffusers import DDPMScheduler
 from utils import DiffusionScheduler
+from profiler import prof
+import aot
 
-TOTAL_TIMESTEPS = conf["timesteps"]
 INF = 1e8
 
 
 def get_args():
-    argp = ArgumentParser()
+    argp = add_conf_args(ArgumentParser())
     argp.add_argument("--device_id", type=int, default=0)
-    argp.add_argument("--dataset", type=str, default="clothing")
-    argp.add_argument("--data_path", type=str, default="datasets")
+    argp.add_argument("--log_dir", type=str, default="logs", help="structured per-run profile log")
+    argp.add_argument("--trace_dir", type=str, default=None, help="jax.profiler trace output")
+    argp.add_argument("--trace_steps", type=str, default=None, help="global train steps to trace, start:end")
     args = argp.parse_args()
     return args
 
@@ -34,12 +37,15 @@ def cal_metrics(
         ):
     
     recall_cnt, pre_cnt, ndcg_cnt, cnt = 0, 0, 0, 0
-    pred_score = all_gen_buns_batch @ bi_mat.T
-    ub_mask_graph_batch = ub_mask_graph_batch.todense()
+    with prof.timer("eval/score"):
+        pred_score = all_gen_buns_batch @ bi_mat.T
+        ub_mask_graph_batch = ub_mask_graph_batch.todense()
 
-    score = pred_score + ub_mask_graph_batch * -INF
+        score = pred_score + ub_mask_graph_batch * -INF
     bs = score.shape[0]
-    _, col_ids = jax.lax.top_k(score, k=topk)
+    with prof.timer("eval/top_k"):
+        _, col_ids = jax.lax.top_k(score, k=topk)
+        col_ids.block_until_ready()
     row_ids = jnp.broadcast_to(jnp.arange(0, bs).reshape(-1, 1), (bs, topk))
     hit = ub_mat[row_ids, col_ids].todense()
 
@@ -82,19 +88,87 @@ def mse(x, y):
     return jnp.mean((x-y) ** 2)
 
 
+def _kl_mse_stats(logits, prob_iids, prob_iids_bundle, chunk_size):
+    """
+    one streaming pass over item chunks, per row:
+    logsumexp(logits), logsumexp(prob_iids), E_q[prob_iids - logits] with q = softmax(prob_iids),
+    and the squared error against prob_iids_bundle
+    """
+    bs, n_item = logits.shape
+    chunk_size = min(chunk_size, n_item)
+    n_chunk = -(-n_item // chunk_size)
+
+    def body(i, carry):
+        m_a, s_a, m_b, s_b, t, sse = carry
+        # the last chunk is shifted back to stay in bounds, overlapping items are masked
+        start = jnp.minimum(i * chunk_size, n_item - chunk_size)
+        a = jax.lax.dynamic_slice_in_dim(logits, start, chunk_size, axis=1)
+        b = jax.lax.dynamic_slice_in_dim(prob_iids, start, chunk_size, axis=1)
+        y = jax.lax.dynamic_slice_in_dim(prob_iids_bundle, start, chunk_size, axis=1)
+        valid = (start + jnp.arange(chunk_size)) >= i * chunk_size
+
+        a_masked = jnp.where(valid, a, -jnp.inf)
+        b_masked = jnp.where(valid, b, -jnp.inf)
+        new_m_a = jnp.maximum(m_a, a_masked.max(axis=1))
+        new_m_b = jnp.maximum(m_b, b_masked.max(axis=1))
+        s_a = s_a * jnp.exp(m_a - new_m_a) + jnp.exp(a_masked - new_m_a[:, None]).sum(axis=1)
+        w_b = jnp.exp(b_masked - new_m_b[:, None])
+        s_b = s_b * jnp.exp(m_b - new_m_b) + w_b.sum(axis=1)
+        t = t * jnp.exp(m_b - new_m_b) + (w_b * jnp.where(valid, b - a, 0)).sum(axis=1)
+        sse = sse + jnp.where(valid, (a - y) ** 2, 0).sum(axis=1)
+        return new_m_a, s_a, new_m_b, s_b, t, sse
+
+    neg_inf = jnp.full((bs,), -jnp.inf, dtype=logits.dtype)
+    zeros = jnp.zeros((bs,), dtype=logits.dtype)
+    m_a, s_a, m_b, s_b, t, sse = jax.lax.fori_loop(0, n_chunk, body, (neg_inf, zeros, neg_inf, zeros, zeros, zeros))
+    return m_a + jnp.log(s_a), m_b + jnp.log(s_b), t / s_b, sse
+
+
+@partial(jax.custom_vjp, nondiff_argnums=(3,))
+def kl_mse_loss(logits, prob_iids, prob_iids_bundle, chunk_size):
+    """
+    fused mse(logits, prob_iids_bundle) & kl_divergence(softmax(logits), softmax(prob_iids)),
+    computed in log space; the backward pass only keeps the inputs and per-row statistics
+    """
+    return _kl_mse_loss_fwd(logits, prob_iids, prob_iids_bundle, chunk_size)[0]
+
+
+def _kl_mse_loss_fwd(logits, prob_iids, prob_iids_bundle, chunk_size):
+    lse_a, lse_b, e, sse = _kl_mse_stats(logits, prob_iids, prob_iids_bundle, chunk_size)
+    mse_loss = sse.sum() / logits.size
+    # KL(q || p) per row = E_q[b - a] - lse_b + lse_a
+    kl_loss = jnp.sum(e - lse_b + lse_a)
+    return (mse_loss, kl_loss), (logits, prob_iids, prob_iids_bundle, lse_a, lse_b, e)
+
+
+def _kl_mse_loss_bwd(chunk_size, res, g):
+    logits, prob_iids, prob_iids_bundle, lse_a, lse_b, e = res
+    g_mse, g_kl = g
+    d_mse = 2 * (logits - prob_iids_bundle) / logits.size * g_mse
+    p = jnp.exp(logits - lse_a[:, None])
+    q = jnp.exp(prob_iids - lse_b[:, None])
+    d_logits = d_mse + g_kl * (p - q)
+    d_prob_iids = g_kl * q * ((prob_iids - logits) - e[:, None])
+    return d_logits, d_prob_iids, -d_mse
+
+
+kl_mse_loss.defvjp(_kl_mse_loss_fwd, _kl_mse_loss_bwd)
+
+
 def train_step(state, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle):
+    bs = uids.shape[0]
+
     def loss_fn(params, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle):
         logits = state.apply_fn(params, uids, prob_iids, noisy_prob_iids_bundle)
-        mse_loss = mse(logits, prob_iids_bundle) # MSE
-
-        slogits = nn.softmax(logits)
-        sprob_iids = nn.softmax(prob_iids)
-        kl_loss = kl_divergence(slogits, sprob_iids) # Kullback-Leibler Divergence (true probability: prob_iids)
+        # MSE + Kullback-Leibler Divergence (true probability: prob_iids), see kl_divergence / mse
+        mse_loss, kl_loss = kl_mse_loss(logits, prob_iids, prob_iids_bundle, conf["loss_chunk"])
+        # kl is summed over rows, rescale the micro batch sum to a per-row mean x batch size (see accumulate_grads)
+        kl_loss = kl_loss * (bs / uids.shape[0])
 
         loss = mse_loss + kl_loss
         return loss, {"loss": loss, "mse": mse_loss, "kl": kl_loss}
 
-    aux, grads = jax.value_and_grad(loss_fn, has_aux=True)(state.params, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle)
+    aux, grads = accumulate_grads(loss_fn, state.params, (uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle), conf["micro_batch"])
     state = state.apply_gradients(grads=grads)
     loss, aux_dict = aux
     return state, loss, aux_dict
@@ -102,42 +176,61 @@ def train_step(state, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle)
 
 def train(state, dataloader, noise_scheduler, epochs, device, key):
     print("TRAINING")
+    train_step_jit = aot.jit(train_step, "kl_train_step", device)
+    train_start = time.perf_counter()
 
     for epoch in range(epochs):
+        epoch_start = time.perf_counter()
         pbar = tqdm(dataloader)
-        for uids, prob_iids, prob_iids_bundle in pbar:
-            uids = jnp.array(uids, dtype=jnp.int32)
-            prob_iids = jnp.array(prob_iids, dtype=jnp.float32)
-            prob_iids_bundle = jnp.array(prob_iids_bundle, jnp.float32)
-
-            randkey, timekey, key = jax.random.split(key, num=3)
-            noise = jax.random.normal(randkey, shape=prob_iids_bundle.shape)
-            timesteps = jax.random.randint(timekey, (prob_iids_bundle.shape[0],), minval=0, maxval=TOTAL_TIMESTEPS-1)
-
-            noisy_prob_iids_bundle = noise_scheduler.add_noise(prob_iids_bundle, noise, timesteps)
-            state, loss, aux_dict = jax.jit(train_step, device=device)(state, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle)
+        for uids, prob_iids, prob_iids_bundle in prof.iter(pbar, "train/collate"):
+            prof.step()
+            with prof.timer("train/to_device"):
+                uids = jnp.array(uids, dtype=jnp.int32)
+                prob_iids = jnp.array(prob_iids, dtype=jnp.float32)
+                prob_iids_bundle = jnp.array(prob_iids_bundle, jnp.float32)
+
+            with prof.timer("train/noise"):
+                randkey, timekey, key = jax.random.split(key, num=3)
+                noise = jax.random.normal(randkey, shape=prob_iids_bundle.shape)
+                timesteps = jax.random.randint(timekey, (prob_iids_bundle.shape[0],), minval=0, maxval=conf["timesteps"]-1)
+
+                noisy_prob_iids_bundle = noise_scheduler.add_noise(prob_iids_bundle, noise, timesteps)
+                noisy_prob_iids_bundle.block_until_ready()
+            stage = "train/compile" if prof.new_shape("train_step", uids, prob_iids) else "train/step"
+            with prof.timer(stage):
+                state, loss, aux_dict = train_step_jit(state, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle)
+                loss.block_until_ready()
+            prof.count("train/samples", uids.shape[0])
             pbar.set_description("EPOCH: %i | LOSS: %.4f | KL_LOSS: %.4f | MSE_LOSS: %.4f" % (epoch, aux_dict["loss"], aux_dict["kl"], aux_dict["mse"]))
+        prof.log("epoch", epoch=epoch, wall_time=time.perf_counter() - epoch_start, loss=float(loss))
+    prof.summary("train", time.perf_counter() - train_start, "train/samples")
     return state
 
 
 def inference(model, state, test_dataloader, noise_scheduler, key, n_item):
     #TODO (bt-nghia): fix inference loop over timesteps
     print("INFERENCE")
+    infer_start = time.perf_counter()
     all_genbundles = []
-    for test_data in test_dataloader:
-        key, rand_key = jax.random.split(key)
-        uids, prob_iids = test_data
-        uids = jnp.array(uids, dtype=jnp.int32)
-        prob_iids = jnp.array(prob_iids, jnp.float32)
-        noisy_prob_iids_bundle = jax.random.normal(rand_key, shape=(uids.shape[0], n_item))
-
-        post_prob_iids_bundle = noisy_prob_iids_bundle
-        for i, t in enumerate(noise_scheduler.timesteps):
-            model_output = model.apply(state.params, uids, prob_iids, post_prob_iids_bundle)
-            post_prob_iids_bundle = noise_scheduler.step(model_output, t, post_prob_iids_bundle)
+    for test_data in prof.iter(test_dataloader, "inference/collate"):
+        with prof.timer("inference/to_device"):
+            key, rand_key = jax.random.split(key)
+            uids, prob_iids = test_data
+            uids = jnp.array(uids, dtype=jnp.int32)
+            prob_iids = jnp.array(prob_iids, jnp.float32)
+            noisy_prob_iids_bundle = jax.random.normal(rand_key, shape=(uids.shape[0], n_item))
+
+        with prof.timer("inference/denoise"):
+            post_prob_iids_bundle = noisy_prob_iids_bundle
+            for i, t in enumerate(noise_scheduler.timesteps):
+                model_output = model.apply(state.params, uids, prob_iids, post_prob_iids_bundle)
+                post_prob_iids_bundle = noise_scheduler.step(model_output, t, post_prob_iids_bundle)
+            post_prob_iids_bundle.block_until_ready()
 
         all_genbundles.append(post_prob_iids_bundle)
+        prof.count("inference/users", uids.shape[0])
     all_genbundles = np.concatenate(all_genbundles, axis=0)
+    prof.summary("inference", time.perf_counter() - infer_start, "inference/users", "users_per_sec")
     return all_genbundles
 
 
@@ -153,6 +246,7 @@ def eval(conf, train_data, test_data, all_gen_buns):
     num_batch = int(len(uids_test) / batch_size)
     batch_idx = np.arange(0, len(uids_test))
     test_batch_loader = DataLoader(batch_idx, batch_size=batch_size, shuffle=False, drop_last=False)
+    eval_start = time.perf_counter()
 
     for topk in [1, 2, 3, 5, 10, 20, 40, 50]:
         recall_cnt = 0
@@ -163,14 +257,16 @@ def eval(conf, train_data, test_data, all_gen_buns):
             start=batch[0]
             end=batch[-1]
 
-            uids_test_batch = uids_test[start:end+1]
-            ub_mask_graph_batch = ub_mask_graph[uids_test_batch]
-            # all_gen_buns_batch = all_gen_buns[uids_test_batch]
-            all_gen_buns_batch = all_gen_buns[start:end+1]
+            with prof.timer("eval/slice"):
+                uids_test_batch = uids_test[start:end+1]
+                ub_mask_graph_batch = ub_mask_graph[uids_test_batch]
+                # all_gen_buns_batch = all_gen_buns[uids_test_batch]
+                all_gen_buns_batch = all_gen_buns[start:end+1]
+                ub_mat_batch = ub_mat[uids_test_batch]
             
             r_cnt, p_cnt, n_cnt = cal_metrics(all_gen_buns_batch,
                                               ub_mask_graph_batch, 
-                                              ub_mat[uids_test_batch],
+                                              ub_mat_batch,
                                               bi_mat,
                                               topk)
             recall_cnt+=r_cnt
@@ -180,6 +276,8 @@ def eval(conf, train_data, test_data, all_gen_buns):
         print("Recall@%i: %s" %(topk, recall_cnt / len(uids_test)))
         print("Precision@%i: %s" %(topk, pre_cnt / len(uids_test)))
         print("NDCG@%i: %s" %(topk, ndcg_cnt / len(uids_test)))
+    prof.count("eval/users", len(uids_test))
+    prof.summary("eval", time.perf_counter() - eval_start, "eval/users", "users_per_sec")
 
 
 def main():
@@ -188,12 +286,7 @@ def main():
     """
     args = get_args()
     dataset_name = args.dataset
-    conf["dataset"] = args.dataset
-    conf["data_path"] = args.data_path
-    nu, nb, ni = get_size(f"{conf['data_path']}/{dataset_name}/{dataset_name}_data_size.txt")
-    conf["n_user"] = nu
-    conf["n_item"] = ni
-    conf["n_bundle"] = nb
+    conf_source = resolve_conf(args)
     devices = jax.devices()
     device = devices[args.device_id]
     conf["device"] = device
@@ -201,6 +294,7 @@ def main():
     rng_infer, rng_gen, rng_model = jax.random.split(jax.random.PRNGKey(2025), num=3)
     np.random.seed(2025)
     print(conf)
+    prof.start(conf, args.log_dir, args.trace_dir, args.trace_steps, conf_source)
 
     """
     Construct Training/Validating/Testing Data
@@ -213,7 +307,7 @@ def main():
     sample_uids = jnp.array([0])
     sample_prob_iids = jnp.empty((1, conf["n_item"]))
     sample_prob_iids_bundle = jnp.empty((1, conf["n_item"]))
-    model = Net(conf, train_data.ui_graph)
+    model = Net(conf)
 
     conf["model_name"] = model.__class__.__name__
     print(f"MODEL NAME: {conf['model_name']}")
@@ -224,7 +318,7 @@ def main():
     state = train_state.TrainState.create(apply_fn=model.apply,
                                           params=params,
                                           tx=optimizer)
-    noise_scheduler = DiffusionScheduler(num_train_timesteps=TOTAL_TIMESTEPS)
+    noise_scheduler = DiffusionScheduler(num_train_timesteps=conf["timesteps"])
 
     dataloader = DataLoader(train_data,
                             batch_size=conf["batch_size"],
@@ -244,9 +338,12 @@ def main():
     """
     Generate & Evaluate
     """
-    generated_bundles_test = inference(model, state, test_dataloader, noise_scheduler, rng_infer, conf["n_item"])
+    sample_scheduler = DiffusionScheduler(num_train_timesteps=conf["sample_steps"] or conf["timesteps"])
+    generated_bundles_test = inference(model, state, test_dataloader, sample_scheduler, rng_infer, conf["n_item"])
     eval(conf, train_data, test_data, generated_bundles_test)
 
+    prof.close()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,86 @@
+import os
+import hashlib
+
+from config import conf
+
+import jax
+import jax.numpy as jnp
+from jax.experimental import serialize_executable
+
+
+def enable_compile_cache(path):
+    """
+    jax persistent compilation cache, repeat runs load compiled executables from path
+    """
+    if not path:
+        return
+    os.makedirs(path, exist_ok=True)
+    jax.config.update("jax_compilation_cache_dir", path)
+    # also the many small eager-op compiles of data prep / eval, not only the big steps
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+
+
+class AotJit:
+    '''
+    jax.jit that serialises each compiled executable to path (one file per input shape),
+    later runs and the serving process load it instead of compiling
+    the file is keyed on the lowered program, so code or config changes never load a stale one
+    '''
+    def __init__(self, fn, name, path, device=None):
+        self.fn = fn
+        self.name = name
+        self.path = path
+        self.device = device or jax.devices()[0]
+        self.executables = {}
+
+    def specs(self, leaves):
+        sharding = jax.sharding.SingleDeviceSharding(self.device)
+        return [jax.ShapeDtypeStruct(x.shape, x.dtype, sharding=sharding) for x in leaves]
+
+    def load_or_compile(self, args):
+        leaves, treedef = jax.tree_util.tree_flatten(args)
+        out_treedef = jax.tree_util.tree_structure(jax.eval_shape(self.fn, *args))
+        # flat in / out, pytree defs may hold functions (apply_fn, optimizer) and are not serialisable
+        flat_fn = lambda *leaves: jax.tree_util.tree_leaves(self.fn(*jax.tree_util.tree_unflatten(treedef, leaves)))
+        lowered = jax.jit(flat_fn).lower(*self.specs(leaves))
+        key = hashlib.sha256((lowered.as_text() + self.device.device_kind + jax.__version__).encode()).hexdigest()[:16]
+        file = f"{self.path}/{self.name}-{key}.xla"
+        if os.path.exists(file):
+            with open(file, "rb") as f:
+                in_tree = jax.tree_util.tree_structure((tuple(leaves), {}))
+                out_tree = jax.tree_util.tree_structure(list(range(out_treedef.num_leaves)))
+                executable = serialize_executable.deserialize_and_load(f.read(), in_tree, out_tree,
+                                                                       execution_devices=[self.device])
+            print(f"AOT LOAD: {file}")
+        else:
+            executable = lowered.compile()
+            os.makedirs(self.path, exist_ok=True)
+            with open(file, "wb") as f:
+                f.write(serialize_executable.serialize(executable)[0])
+            print(f"AOT SAVE: {file}")
+        return executable, out_treedef
+
+    def executable(self, *args):
+        """
+        executable & output pytree def for the shapes of args (arrays or jax.ShapeDtypeStruct)
+        """
+        leaves, treedef = jax.tree_util.tree_flatten(args)
+        signature = (treedef, tuple((x.shape, x.dtype) for x in leaves))
+        if signature not in self.executables:
+            self.executables[signature] = self.load_or_compile(args)
+        return self.executables[signature]
+
+    def __call__(self, *args):
+        # python scalars (e.g. a fresh TrainState.step) as arrays
+        args = jax.tree_util.tree_map(lambda x: x if hasattr(x, "shape") else jnp.asarray(x), args)
+        executable, out_treedef = self.executable(*args)
+        return jax.tree_util.tree_unflatten(out_treedef, executable(*jax.tree_util.tree_leaves(args)))
+
+
+def jit(fn, name, device=None):
+    """
+    jax.jit(fn), or AotJit under conf["aot_path"]
+    """
+    if conf["aot_path"]:
+        return AotJit(fn, name, conf["aot_path"], device)
+    return jax.jit(fn, device=device)
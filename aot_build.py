@@ -0,0 +1,90 @@
+from functools import partial
+from argparse import ArgumentParser
+
+from config import conf, add_conf_args, resolve_conf
+from utils import *
+
+import jax
+import jax.numpy as jnp
+import optax
+from model import Net
+from flax.training import train_state
+from jax.experimental import sparse
+from main import train_step, sample_step, ensemble_sample_step, validation_step, masked_top_k
+import aot
+
+
+def get_args():
+    argp = add_conf_args(ArgumentParser())
+    argp.add_argument("--device_id", type=int, default=0)
+    args = argp.parse_args()
+    return args
+
+
+def batch_sizes(n, batch_size):
+    """
+    shapes a drop_last=False loader over n rows produces
+    """
+    sizes = [min(batch_size, n)]
+    if n > batch_size and n % batch_size:
+        sizes.append(n % batch_size)
+    return sizes
+
+
+def main():
+    """
+    Compile & serialise the train / sample / eval executables of main.py for this config and dataset,
+    without training; main.py and cold_start.py with the same --aot_path load them
+    """
+    args = get_args()
+    resolve_conf(args)
+    assert conf["aot_path"], "pass --aot_path"
+    device = jax.devices()[args.device_id]
+    nu, nb, ni = conf["n_user"], conf["n_bundle"], conf["n_item"]
+    n_test = len(TestData(conf, "test"))
+    spec = lambda *shape, dtype=jnp.float32: jax.ShapeDtypeStruct(shape, dtype)
+
+    model = Net(conf)
+    params = jax.eval_shape(lambda: model.init(jax.random.PRNGKey(0), jnp.zeros((1,), jnp.int32),
+                                               jnp.zeros((1, ni)), jnp.zeros((1, ni))))
+    state = jax.eval_shape(lambda: train_state.TrainState.create(apply_fn=model.apply, params=params,
+                                                                 tx=optax.adam(learning_rate=1e-3)))
+    state = state.replace(apply_fn=model.apply)
+
+    train_step_jit = aot.jit(train_step, "train_step", device)
+    for bs in batch_sizes(nu, conf["batch_size"]):
+        # the users' pool rows only go in with cold_align (see main.train)
+        pool = (spec(bs, ni),) if conf["cold_align"] else ()
+        train_step_jit.executable(state, spec(bs, dtype=jnp.int32), spec(bs, ni), spec(bs, ni), spec(bs, ni), *pool)
+
+    # the in-training validator of main.make_validator, on the fp32 params
+    n_val = len(TestData(conf, "tune").test_uid)
+    if n_val and conf["val_interval"] > 0:
+        n_val = min(conf["val_users"], n_val)
+        val_scheduler = DiffusionScheduler(num_train_timesteps=conf["sample_steps"] or conf["timesteps"])
+        validation_step_jit = aot.jit(partial(validation_step, model.apply, val_scheduler, conf["val_topk"]),
+                                      "validation_step", device)
+        validation_step_jit.executable(params, spec(n_val, dtype=jnp.int32), spec(n_val, ni), spec(n_val, nb),
+                                       spec(n_val, nb), sparse.BCOO.from_scipy_sparse(TrainData(conf).bi_graph),
+                                       spec(2, dtype=jnp.uint32))
+
+    if conf["quant"] != "none":
+        model = Net(conf, quant=conf["quant"])
+        params = jax.eval_shape(lambda: model.init(jax.random.PRNGKey(0), jnp.zeros((1,), jnp.int32),
+                                                   jnp.zeros((1, ni)), jnp.zeros((1, ni))))
+    noise_scheduler = DiffusionScheduler(num_train_timesteps=conf["sample_steps"] or conf["timesteps"])
+    # same selection as main.sample_jit, the reduce of the samples stays a plain jax.jit
+    if conf["n_sample"] > 1:
+        sample_step_jit = aot.jit(partial(ensemble_sample_step, model.apply, noise_scheduler), "ensemble_sample_step", device)
+    else:
+        sample_step_jit = aot.jit(partial(sample_step, model.apply, noise_scheduler), "sample_step", device)
+    for bs in batch_sizes(n_test, conf["batch_size"]):
+        noise_shape = (bs, ni) if conf["n_sample"] == 1 else (conf["n_sample"], bs, ni)
+        sample_step_jit.executable(params, spec(bs, dtype=jnp.int32), spec(bs, ni), spec(*noise_shape),
+                                   spec(dtype=noise_scheduler.timesteps.dtype))
+        for topk in [1, 2, 3, 5, 10, 20, 40, 50]:
+            aot.jit(partial(masked_top_k, topk=topk), f"top_k{topk}", device).executable(spec(bs, nb), spec(bs, nb))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+from argparse import ArgumentParser
+
+from config import conf, add_conf_args, resolve_conf
+from utils import *
+
+import jax
+import jax.numpy as jnp
+import optax
+from model import Net, REMAT_POLICIES
+from flax.training import train_state
+from main import train_step
+
+
+def get_args():
+    argp = add_conf_args(ArgumentParser())
+    argp.add_argument("--catalog", type=str, default=None,
+                      help="probe n_user x n_item x n_bundle instead of the dataset's sizes, e.g. 100000x1000000x200000")
+    argp.add_argument("--mem_budget", type=float, default=None,
+                      help="device memory in GB, default: the device's bytes_limit")
+    argp.add_argument("--remats", type=str, nargs="+", default=REMAT_POLICIES, help="remat policies to compare")
+    argp.add_argument("--max_batch_size", type=int, default=1 << 17)
+    args = argp.parse_args()
+    return args
+
+
+def device_budget():
+    stats = jax.local_devices()[0].memory_stats() or {}
+    return stats.get("bytes_limit")
+
+
+def step_memory(run_conf, batch_size, breakdown=False):
+    """
+    XLA's compiled memory estimate (bytes) of one train step, nothing is allocated
+    breakdown: also return the (argument, temp) bytes
+    """
+    model = Net(run_conf)
+    n_item = run_conf["n_item"]
+    uids = jax.ShapeDtypeStruct((batch_size,), jnp.int32)
+    x = jax.ShapeDtypeStruct((batch_size, n_item), jnp.float32)
+    state = jax.eval_shape(lambda: train_state.TrainState.create(
+        apply_fn=model.apply,
+        params=model.init(jax.random.PRNGKey(0), jnp.zeros((1,), jnp.int32), jnp.zeros((1, n_item)), jnp.zeros((1, n_item))),
+        tx=optax.adam(learning_rate=1e-3)))
+    state = state.replace(apply_fn=model.apply)
+    compiled = jax.jit(train_step, donate_argnums=(0,)).lower(state, uids, x, x, x, *([x] if conf["cold_align"] else [])).compile()
+    mem = compiled.memory_analysis()
+    total = mem.argument_size_in_bytes + mem.output_size_in_bytes + mem.temp_size_in_bytes - mem.alias_size_in_bytes
+    if breakdown:
+        return total, mem.argument_size_in_bytes, mem.temp_size_in_bytes
+    return total
+
+
+def max_batch_size(run_conf, budget, max_bs):
+    """
+    largest power of two batch size under budget, refined by bisection
+    """
+    lo, hi = 0, 1
+    while hi <= max_bs and step_memory(run_conf, hi) <= budget:
+        lo, hi = hi, hi * 2
+    if lo == 0 or hi > max_bs:
+        return min(lo, max_bs)
+    while hi - lo > max(lo // 16, 1):
+        mid = (lo + hi) // 2
+        if step_memory(run_conf, mid) <= budget:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def main():
+    """
+    largest train batch size per remat policy (conf["micro_batch"] applies to all of them),
+    from XLA's memory estimate of the compiled step
+    """
+    args = get_args()
+    resolve_conf(args)
+    if args.catalog is not None:
+        conf["n_user"], conf["n_item"], conf["n_bundle"] = [int(n) for n in args.catalog.split("x")]
+    budget = device_budget() if args.mem_budget is None else args.mem_budget * 2**30
+    assert budget is not None, "device reports no memory limit, pass --mem_budget"
+    print("BATCH PROBE: n_user %d n_item %d micro_batch %d budget %.2fGB"
+          % (conf["n_user"], conf["n_item"], conf["micro_batch"], budget / 2**30))
+
+    base = None
+    # args: params, optimizer state & the (bs, n_item) batch inputs, temp: activations & gradients
+    print("%-34s %8s %8s %8s %10s %8s" % ("remat", "mem(GB)", "args", "temp", "max_bs", "x none"))
+    for remat in args.remats:
+        run_conf = dict(conf, remat=remat)
+        bs = max_batch_size(run_conf, budget, args.max_batch_size)
+        mem, args_mem, temp_mem = [m / 2**30 for m in step_memory(run_conf, max(bs, 1), breakdown=True)]
+        base = bs if base is None else base
+        ratio = bs / base if base else float("nan")
+        print("%-34s %8.3f %8.3f %8.3f %10d %8.2f" % (remat, mem, args_mem, temp_mem, bs, ratio))
+
+
+if __name__ == "__main__":
+    main()
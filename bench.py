@@ -0,0 +1,227 @@
+import os
+os.environ.setdefault("JAX_PLATFORMS", "cpu")
+
+import sys
+import json
+import time
+import platform
+import subprocess
+from argparse import ArgumentParser
+
+from config import conf
+from utils import *
+
+import jax
+import jax.numpy as jnp
+import optax
+from model import Net
+from flax.training import train_state
+from gen_data import generate
+import graph
+from profiler import prof
+from main import train_step, inference, cal_metrics
+
+
+DATASETS = ["Steam_cold", "Youshu_cold", "meal_cold", "iFashion_cold", "NetEase_cold"]
+# user_item.txt is optional (empty ui graph, see graph.read_pairs)
+REQUIRED_FILES = ["bundle_item.txt", "user_bundle_train.txt", "user_bundle_test.txt"]
+ENTRY_POINTS = ["main", "KL_main", "cold_start", "rank_main", "incremental", "sweep"]
+# must not be pulled in by importing an entry point
+HEAVY_MODULES = ["torch", "diffusers", "tensorflow", "pandas"]
+STARTUP_SCRIPT = """
+import sys, json, time, resource
+start = time.perf_counter()
+import %s
+print(json.dumps({"time": time.perf_counter() - start,
+                  "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  "heavy": [m for m in %r if m in sys.modules]}))
+"""
+
+
+def get_args():
+    argp = ArgumentParser()
+    argp.add_argument("--data_path", type=str, default="datasets")
+    argp.add_argument("--datasets", type=str, nargs="*", default=DATASETS)
+    argp.add_argument("--synthetic", type=str, nargs="*", default=["10000x20000x5000"],
+                      help="synthetic catalogs as n_user x n_item x n_bundle")
+    argp.add_argument("--synthetic_path", type=str, default="bench_data")
+    argp.add_argument("--repeat", type=int, default=5)
+    argp.add_argument("--startup_repeat", type=int, default=3, help="fresh interpreters per entry point import, 0: skip")
+    argp.add_argument("--batch_size", type=int, default=256)
+    argp.add_argument("--out", type=str, default="bench.json")
+    argp.add_argument("--compare", type=str, default=None, help="previous report, exit 1 on regression")
+    argp.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown in --compare")
+    args = argp.parse_args()
+    return args
+
+
+def timeit(fn, repeat, warmup=1):
+    """
+    median / min wall time of fn() in seconds, results are blocked on
+    """
+    for _ in range(warmup):
+        jax.block_until_ready(fn())
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        jax.block_until_ready(fn())
+        times.append(time.perf_counter() - start)
+    return {"median": float(np.median(times)), "min": float(np.min(times))}
+
+
+def make_synthetic(data_path, name, n_user, n_item, n_bundle, seed=2025):
+    """
+    power law catalog in the dataset file format (see gen_data.py), 20 items / user, 5 items / bundle
+    """
+    if os.path.exists(f"{data_path}/{name}/{name}_data_size.txt"):
+        return
+    generate(data_path, name, n_user, n_item, n_bundle,
+             ui_per_user=20, ub_per_user=4, bundle_size=5, seed=seed)
+
+
+def bench_dataset(data_path, dataset_name, batch_size, repeat):
+    missing = [f for f in REQUIRED_FILES if not os.path.exists(f"{data_path}/{dataset_name}/{f}")]
+    if missing:
+        return {"skipped": "missing " + ", ".join(missing)}
+
+    conf["dataset"] = dataset_name
+    conf["data_path"] = data_path
+    conf["batch_size"] = batch_size
+    nu, nb, ni = get_size(f"{data_path}/{dataset_name}/{dataset_name}_data_size.txt")
+    conf["n_user"] = nu
+    conf["n_item"] = ni
+    conf["n_bundle"] = nb
+    np.random.seed(2025)
+    rng_noise, rng_model = jax.random.split(jax.random.PRNGKey(2025))
+    result = {"n_user": int(nu), "n_item": int(ni), "n_bundle": int(nb)}
+
+    # PROFILE lines are per dataset, not accumulated over the whole run
+    prof.reset()
+
+    # data load, parsed from the files every time (the first load warms the os file cache)
+    def data_load():
+        graph._GRAPHS.clear()
+        TrainData(conf)
+        TestData(conf, "test")
+    result["data_load"] = timeit(data_load, repeat)
+    train_data = TrainData(conf)
+    test_data = TestData(conf, "test")
+
+    # batch collation
+    dataloader = DataLoader(train_data, batch_size=batch_size, shuffle=True, drop_last=True)
+    def forever():
+        while True:
+            yield from dataloader
+    batches = forever()
+    result["collate"] = timeit(lambda: next(batches), repeat)
+    uids, prob_iids, prob_iids_bundle = next(iter(dataloader))
+    pool_iids = jnp.array(train_data.pool_rows(uids), dtype=jnp.float32) if conf["cold_align"] else None
+    uids = jnp.array(uids, dtype=jnp.int32)
+    prob_iids = jnp.array(prob_iids, dtype=jnp.float32)
+    prob_iids_bundle = jnp.array(prob_iids_bundle, dtype=jnp.float32)
+
+    # train step (compiled, steady state)
+    model = Net(conf)
+    params = model.init(rng_model, uids[:1], prob_iids[:1], prob_iids_bundle[:1])
+    state = train_state.TrainState.create(apply_fn=model.apply, params=params, tx=optax.adam(learning_rate=1e-3))
+    noise_scheduler = DiffusionScheduler(num_train_timesteps=conf["timesteps"])
+    timesteps = jax.random.randint(rng_noise, (batch_size,), minval=0, maxval=conf["timesteps"]-1)
+    noisy_prob_iids_bundle = noise_scheduler.add_noise(prob_iids_bundle, jax.random.normal(rng_noise, prob_iids_bundle.shape), timesteps)
+    train_step_jit = jax.jit(train_step)
+    result["train_step"] = timeit(lambda: train_step_jit(state, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle, pool_iids)[1], repeat)
+    result["train_samples_per_sec"] = batch_size / result["train_step"]["median"]
+
+    # full denoising pass over one test batch
+    test_batch = next(iter(DataLoader(test_data, batch_size=batch_size, shuffle=False, drop_last=False)))
+    # the warm-up call traces & compiles, main.sample_jit reuses the sampler afterwards
+    def denoise():
+        # one PROFILE line per call
+        prof.reset()
+        return inference(model, state, [test_batch], noise_scheduler, rng_noise, ni)
+    result["denoise"] = timeit(denoise, repeat)
+    result["denoise_users_per_sec"] = len(test_batch[0]) / result["denoise"]["median"]
+    gen = denoise()
+
+    # evaluation of that batch
+    uids_test_batch = test_data.test_uid[:len(gen)]
+    result["eval"] = timeit(lambda: cal_metrics(gen, train_data.ub_graph[uids_test_batch],
+                                                test_data.ub_graph[uids_test_batch], train_data.bi_graph, 20)[2],
+                            repeat)
+    return result
+
+
+def bench_startup(repeat):
+    """
+    import time & peak RSS of each entry point in a fresh interpreter
+    """
+    result = {}
+    for module in ENTRY_POINTS:
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT % (module, HEAVY_MODULES)],
+                                 capture_output=True, text=True, check=True)
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        times = [r["time"] for r in runs]
+        rss = [r["rss_mb"] for r in runs]
+        result[f"import_{module}"] = {"median": float(np.median(times)), "min": float(np.min(times))}
+        result[f"import_{module}_rss_mb"] = {"median": float(np.median(rss)), "min": float(np.min(rss))}
+        result[f"import_{module}_heavy"] = runs[0]["heavy"]
+        if runs[0]["heavy"]:
+            print(f"WARNING: import {module} loads " + ", ".join(runs[0]["heavy"]))
+    return result
+
+
+def compare(report, baseline, tolerance):
+    """
+    relative change of every timed (median) entry, True when none regressed beyond tolerance
+    """
+    ok = True
+    for name, result in report["results"].items():
+        base = baseline["results"].get(name, {})
+        for key, value in result.items():
+            if not isinstance(value, dict) or not isinstance(base.get(key), dict):
+                continue
+            ratio = value["median"] / max(base[key]["median"], 1e-12)
+            flag = "REGRESSION" if ratio > 1 + tolerance else ""
+            ok = ok and not flag
+            print("%-28s %-24s %10.4f -> %10.4f  x%.2f %s" % (name, key, base[key]["median"], value["median"], ratio, flag))
+    return ok
+
+
+def main():
+    args = get_args()
+    report = {"platform": platform.platform(),
+              "devices": [str(d) for d in jax.devices()],
+              "jax": jax.__version__,
+              "batch_size": args.batch_size,
+              "timesteps": conf["timesteps"],
+              "results": {}}
+
+    if args.startup_repeat > 0:
+        print("BENCH startup")
+        report["results"]["startup"] = bench_startup(args.startup_repeat)
+
+    for name in args.datasets:
+        print(f"BENCH {name}")
+        report["results"][name] = bench_dataset(args.data_path, name, args.batch_size, args.repeat)
+
+    for shape in args.synthetic:
+        n_user, n_item, n_bundle = [int(n) for n in shape.split("x")]
+        name = f"synthetic_{shape}"
+        print(f"BENCH {name}")
+        make_synthetic(args.synthetic_path, name, n_user, n_item, n_bundle)
+        report["results"][name] = bench_dataset(args.synthetic_path, name, args.batch_size, args.repeat)
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"REPORT: {args.out}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
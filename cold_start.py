@@ -0,0 +1,90 @@
+import os
+from argparse import ArgumentParser
+
+from config import conf, add_conf_args, resolve_conf
+from utils import *
+
+import jax
+import jax.numpy as jnp
+from model import Net
+from main import eval
+import aot
+
+
+def get_args():
+    argp = add_conf_args(ArgumentParser())
+    argp.add_argument("--device_id", type=int, default=0)
+    args = argp.parse_args()
+    return args
+
+
+def load_cold_model(conf):
+    """
+    Net without the user table: n_user=1 placeholder, params from the *_net_cold checkpoint
+    """
+    cold_conf = dict(conf, n_user=1)
+    model = Net(cold_conf)
+    params = jax.eval_shape(lambda: model.init(jax.random.PRNGKey(0),
+                                               jnp.zeros((1,), dtype=jnp.int32),
+                                               jnp.empty((1, conf["n_item"])),
+                                               jnp.empty((1, conf["n_item"]))))
+    path = f"{conf['ckpt_path']}/{conf['dataset']}_net_cold.msgpack"
+    # main.py only writes it when pool_user was aligned, an unaligned one would serve random user vectors
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path}: train with --cold_align > 0 to serve cold-start users")
+    params = load_checkpoint(path, params)
+    return model, params
+
+
+def cold_inference(model, params, test_dataloader, train_data, noise_scheduler, key, n_item):
+    """
+    same sampler as main.inference, user representation pooled from the items the user touched (train_data.pool_rows)
+    """
+    print("COLD INFERENCE")
+    denoise_step = aot.jit(lambda params, prob_iids, pool_iids, x: model.apply(params, prob_iids, pool_iids, x, method=Net.cold_call),
+                           "cold_denoise_step")
+    all_genbundles = []
+    for test_data in test_dataloader:
+        key, rand_key = jax.random.split(key)
+        uids, prob_iids = test_data
+        pool_iids = jnp.array(train_data.pool_rows(uids), jnp.float32)
+        prob_iids = jnp.array(prob_iids, jnp.float32)
+        noisy_prob_iids_bundle = jax.random.normal(rand_key, shape=(prob_iids.shape[0], n_item))
+
+        post_prob_iids_bundle = noisy_prob_iids_bundle
+        for i, t in enumerate(noise_scheduler.timesteps):
+            model_output = denoise_step(params, prob_iids, pool_iids, post_prob_iids_bundle)
+            post_prob_iids_bundle = noise_scheduler.step(model_output, t, post_prob_iids_bundle)
+
+        all_genbundles.append(post_prob_iids_bundle)
+    all_genbundles = np.concatenate(all_genbundles, axis=0)
+    return all_genbundles
+
+
+def main():
+    """
+    Load Config & Cold Model
+    """
+    args = get_args()
+    dataset_name = args.dataset
+    resolve_conf(args)
+
+    rng_infer = jax.random.PRNGKey(2025)
+    model, params = load_cold_model(conf)
+
+    """
+    Score Test Users As Unseen Users
+    """
+    train_data = TrainData(conf)
+    test_data = TestData(conf, "test")
+    test_dataloader = DataLoader(test_data,
+                                 batch_size=conf["batch_size"],
+                                 shuffle=False,
+                                 drop_last=False)
+    sample_scheduler = DiffusionScheduler(num_train_timesteps=conf["sample_steps"] or conf["timesteps"])
+    generated_bundles_test = cold_inference(model, params, test_dataloader, train_data, sample_scheduler, rng_infer, conf["n_item"])
+    eval(conf, train_data, test_data, generated_bundles_test)
+
+
+if __name__ == "__main__":
+    main()
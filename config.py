@@ -1,10 +1,129 @@
+import os
+import json
+
+
 conf = {
-    "ckpt_path": "/checkpoints",
+    "ckpt_path": "checkpoints",
     "data_path": "datasets",
-    "epochs": 100,
     "n_layer": 2,
+    "n_prop_layer": 1,
     "n_dim": 128,
     "batch_size": 1024,
+    "micro_batch": 0,
+    "remat": "none",
     "epoch": 100,
+    "val_interval": 5,
+    "val_users": 2048,
+    "val_topk": 20,
+    "patience": 3,
     "timesteps": 100,
+    "sample_steps": 0,
+    "n_sample": 1,
+    "quant": "none",
+    "eval_workers": 1,
+    "load_repeat": False,
+    "loss_chunk": 4096,
+    "rank_epoch": 50,
+    "rank_batch_size": 2048,
+    "rank_lr": 1e-3,
+    "c_temp": 0.25,
+    "c_lambda": 0.04,
+    "n_candidate": 100,
+    "incr_epoch": 5,
+    "cold_align": 0.0,
+    "compile_cache": "jax_cache",
+    "aot_path": "",
 }
+
+# every knob above, typed by its default; later layers override earlier ones:
+# defaults < configs/{dataset}.json profile < DIFFREC_<KEY> env < --<key> CLI
+DEFAULTS = dict(conf)
+PROFILE_PATH = "configs"
+ENV_PREFIX = "DIFFREC_"
+# read from {dataset}_data_size.txt, a profile may only pin them for validation
+SIZE_KEYS = ["n_user", "n_bundle", "n_item"]
+
+
+def str2bool(value):
+    """
+    bool, 0 / 1 (e.g. a json profile) or a string
+    """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in [0, 1]:
+        return bool(value)
+    if isinstance(value, str) and value.lower() in ["1", "true", "yes"]:
+        return True
+    if isinstance(value, str) and value.lower() in ["0", "false", "no"]:
+        return False
+    raise ValueError(f"not a boolean: {value!r}")
+
+
+def cast(key, value):
+    """
+    value (json / env / CLI string) as the type of the key's default
+    """
+    if key not in DEFAULTS:
+        raise KeyError(f"unknown config key {key}")
+    default = DEFAULTS[key]
+    if isinstance(default, bool):
+        return str2bool(value)
+    if isinstance(default, int) and isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"{key} expects an int, got {value}")
+    return type(default)(value)
+
+
+def add_conf_args(argp):
+    """
+    one --<key> flag per config knob, unset flags keep the lower layers
+    """
+    argp.add_argument("--dataset", type=str, default="clothing")
+    argp.add_argument("--profile", type=str, default=None, help=f"config profile, default {PROFILE_PATH}/<dataset>.json")
+    for key, default in DEFAULTS.items():
+        argp.add_argument(f"--{key}", type=str, default=None, help=f"default {default}")
+    return argp
+
+
+def resolve_conf(args, conf=conf):
+    """
+    fill conf in place from the layers above and the dataset sizes, print & return the source of every key
+    """
+    source = {key: "default" for key in DEFAULTS}
+    conf.update(DEFAULTS)
+    conf["dataset"] = args.dataset
+
+    profile_file = args.profile or f"{PROFILE_PATH}/{args.dataset}.json"
+    expected_size = {}
+    if args.profile is not None or os.path.exists(profile_file):
+        with open(profile_file) as f:
+            profile = json.load(f)
+        for key, value in profile.items():
+            if key in SIZE_KEYS:
+                expected_size[key] = int(value)
+                continue
+            conf[key] = cast(key, value)
+            source[key] = profile_file
+
+    for key in DEFAULTS:
+        if ENV_PREFIX + key.upper() in os.environ:
+            conf[key] = cast(key, os.environ[ENV_PREFIX + key.upper()])
+            source[key] = "env"
+        if getattr(args, key, None) is not None:
+            conf[key] = cast(key, getattr(args, key))
+            source[key] = "cli"
+
+    from graph import get_size
+    size_file = f"{conf['data_path']}/{args.dataset}/{args.dataset}_data_size.txt"
+    for key, value in zip(SIZE_KEYS, get_size(size_file)):
+        if key in expected_size and expected_size[key] != value:
+            raise ValueError(f"{key}: profile {profile_file} says {expected_size[key]}, {size_file} says {value}")
+        conf[key] = int(value)
+        source[key] = size_file
+
+    from aot import enable_compile_cache
+    enable_compile_cache(conf["compile_cache"])
+
+    if conf["micro_batch"] < 0 or conf["batch_size"] <= 0:
+        raise ValueError("batch_size must be > 0 and micro_batch >= 0")
+    print("CONFIG: " + ", ".join(f"{key}={conf[key]} ({src})" for key, src in source.items() if src != "default"))
+    return source
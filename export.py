@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import multiprocessing as mp
+from argparse import ArgumentParser
+
+from config import conf, add_conf_args, resolve_conf
+from utils import *
+
+import jax
+import jax.numpy as jnp
+from flax.training import train_state
+from main import inference, top_k_jit
+
+
+# per worker: the loaded net, graphs & scheduler, shared by all the shards it exports
+NET = {}
+
+
+class ServeData(Dataset):
+    '''
+    (uid, item row) of the given users, from the graphs saved with the checkpoint
+    '''
+    def __init__(self, ui_graph, uids):
+        super().__init__()
+        self.ui_graph = ui_graph
+        self.uids = uids
+
+    def __getitem__(self, index):
+        uid = self.uids[index]
+        return uid, self.ui_graph[uid].toarray().reshape(-1)
+
+    def __getitems__(self, indices):
+        uids = self.uids[indices]
+        return uids, self.ui_graph[uids].toarray()
+
+    def __len__(self):
+        return len(self.uids)
+
+
+def get_args():
+    argp = add_conf_args(ArgumentParser())
+    argp.add_argument("--topk", type=int, default=50)
+    argp.add_argument("--users", type=str, default="all", choices=["all", "test"],
+                      help="every user, or the users of the test split")
+    argp.add_argument("--shard_size", type=int, default=4096, help="users per shard (one result file set each)")
+    argp.add_argument("--workers", type=int, default=1, help="shard processes, spread over devices / cpu cores")
+    argp.add_argument("--out", type=str, default=None, help="default exports/<dataset>")
+    args = argp.parse_args()
+    return args
+
+
+def shard_files(out, shard):
+    """
+    {out}/shard-xxxxx.{uids,ids,scores}.npy & the .done marker written once all three are in place
+    """
+    prefix = f"{out}/shard-{shard:05d}"
+    return {"uids": f"{prefix}.uids.npy", "ids": f"{prefix}.ids.npy", "scores": f"{prefix}.scores.npy",
+            "done": f"{prefix}.done"}
+
+
+def save_npy(path, array):
+    # write & rename, a crash never leaves a truncated file under the final name
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+
+def load_shard(out, shard):
+    """
+    (uids, bundle ids, scores) of a finished shard, memory-mapped
+    """
+    files = shard_files(out, shard)
+    return tuple(np.load(files[k], mmap_mode="r") for k in ["uids", "ids", "scores"])
+
+
+def export_shard(task):
+    """
+    generate, score & top-k one shard of users, write its files
+    """
+    shard, uids, topk, out = task
+    start = time.perf_counter()
+    if not NET:
+        model, params = load_net(conf, conf["quant"])
+        devices = jax.devices()
+        params = jax.device_put(params, devices[WORKER["index"] % len(devices)])
+        NET["net"] = (model, train_state.TrainState(step=0, apply_fn=model.apply, params=params, tx=None, opt_state=None))
+        # incremental.py may have grown the users since the dataset files, serve from the checkpoint's graphs
+        NET["graphs"] = TrainData(dict(conf, n_user=ckpt_n_user(conf)), f"{conf['ckpt_path']}/{conf['dataset']}_graphs.npz")
+        # one scheduler per worker, so every shard reuses the compiled sampler (see main.sample_jit)
+        NET["scheduler"] = DiffusionScheduler(num_train_timesteps=conf["sample_steps"] or conf["timesteps"])
+    model, state = NET["net"]
+    graphs = NET["graphs"]
+
+    data = ServeData(graphs.ui_graph, uids)
+    dataloader = DataLoader(data, batch_size=conf["batch_size"], shuffle=False, drop_last=False)
+    sample_scheduler = NET["scheduler"]
+    # keyed on the shard, a resumed run reproduces the same output whichever worker picks it up
+    key = jax.random.fold_in(jax.random.PRNGKey(2025), shard)
+    generated = inference(model, state, dataloader, sample_scheduler, key, conf["n_item"])
+
+    ids, scores = [], []
+    for begin in range(0, len(uids), conf["batch_size"]):
+        batch = uids[begin:begin + conf["batch_size"]]
+        pred_score = np.asarray(generated[begin:begin + len(batch)] @ graphs.bi_graph.T, dtype=np.float32)
+        # bundles the user already has are not recommended again
+        ub_mask = np.asarray(graphs.ub_graph[batch].todense(), dtype=np.float32)
+        score, col_ids = top_k_jit(topk)(pred_score, ub_mask)
+        ids.append(np.asarray(col_ids, dtype=np.int32))
+        scores.append(np.asarray(score, dtype=np.float16))
+
+    files = shard_files(out, shard)
+    save_npy(files["uids"], np.asarray(uids, dtype=np.int32))
+    save_npy(files["ids"], np.concatenate(ids))
+    save_npy(files["scores"], np.concatenate(scores))
+    open(files["done"], "w").close()
+    return shard, len(uids), time.perf_counter() - start
+
+
+def main():
+    """
+    Config & Shards
+    """
+    args = get_args()
+    resolve_conf(args)
+    out = args.out or f"exports/{conf['dataset']}"
+    os.makedirs(out, exist_ok=True)
+
+    if args.users == "all":
+        uids = np.arange(ckpt_n_user(conf))
+    else:
+        uids = get_graphs(conf).ub_graph("test").sum(axis=1).nonzero()[0]
+    shards = [uids[begin:begin + args.shard_size] for begin in range(0, len(uids), args.shard_size)]
+
+    manifest = {"dataset": conf["dataset"], "users": args.users, "n_user": len(uids), "topk": args.topk,
+                "shard_size": args.shard_size, "n_shard": len(shards), "quant": conf["quant"],
+                "files": "shard-xxxxx.uids.npy int32 [n], .ids.npy int32 [n, topk], .scores.npy float16 [n, topk]"}
+    manifest_file = f"{out}/manifest.json"
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            previous = json.load(f)
+        # a resumed run must produce the same shards
+        assert previous == manifest, f"{out} holds an export with different settings, pick another --out"
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    todo = [(shard, shard_uids, args.topk, out) for shard, shard_uids in enumerate(shards)
+            if not os.path.exists(shard_files(out, shard)["done"])]
+    print(f"EXPORT: {len(uids)} users in {len(shards)} shards, {len(shards) - len(todo)} done, {args.workers} workers -> {out}")
+
+    """
+    Export
+    """
+    start = time.perf_counter()
+    n_done = 0
+    # fork before this process touches a jax backend
+    ctx = mp.get_context("fork")
+    with ctx.Pool(args.workers, initializer=init_worker, initargs=(ctx.Value("i", 0), args.workers)) as pool:
+        for shard, n, shard_time in pool.imap_unordered(export_shard, todo):
+            n_done += n
+            print(f"EXPORT shard {shard}: {n} users in {shard_time:.2f}s")
+    wall = time.perf_counter() - start
+    print(f"EXPORT DONE: {n_done} users in {wall:.2f}s, {n_done / max(wall, 1e-8):.1f} users/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+
+def get_args():
+    argp = ArgumentParser()
+    argp.add_argument("--data_path", type=str, default="datasets")
+    argp.add_argument("--dataset", type=str, default="synthetic_cold")
+    argp.add_argument("--n_user", type=int, default=100000)
+    argp.add_argument("--n_item", type=int, default=1000000)
+    argp.add_argument("--n_bundle", type=int, default=200000)
+    argp.add_argument("--ui_per_user", type=float, default=50, help="mean user-item interactions per user")
+    argp.add_argument("--ub_per_user", type=float, default=10, help="mean user-bundle interactions per user")
+    argp.add_argument("--bundle_size", type=float, default=8, help="mean items per bundle")
+    argp.add_argument("--max_bundle_size", type=int, default=100)
+    argp.add_argument("--item_alpha", type=float, default=1.1, help="power law exponent of item popularity")
+    argp.add_argument("--bundle_alpha", type=float, default=1.1, help="power law exponent of bundle popularity")
+    argp.add_argument("--user_alpha", type=float, default=0., help="power law exponent of user activity, 0: uniform")
+    argp.add_argument("--split", type=str, default="cold", choices=["cold", "random"],
+                      help="cold: tune/test bundles never appear in train, random: per interaction")
+    argp.add_argument("--tune_ratio", type=float, default=0.1)
+    argp.add_argument("--test_ratio", type=float, default=0.2)
+    argp.add_argument("--chunk_size", type=int, default=100000, help="users / bundles generated per write")
+    argp.add_argument("--seed", type=int, default=2025)
+    args = argp.parse_args()
+    return args
+
+
+class PowerLaw:
+    '''
+    O(1) memory sampler of ids in [0, n) with P(rank r) ~ r^-alpha,
+    ranks are scattered over the id space by a fixed affine permutation
+    '''
+    def __init__(self, n, alpha, rng):
+        self.n = n
+        self.alpha = alpha
+        self.mul = self.coprime(n, rng)
+        self.offset = int(rng.integers(0, n))
+
+    @staticmethod
+    def coprime(n, rng):
+        while True:
+            mul = int(rng.integers(1, max(n, 2)))
+            if np.gcd(mul, n) == 1:
+                return mul
+
+    def ranks(self, rng, size):
+        u = rng.random(size)
+        if self.alpha == 0:
+            return (u * self.n).astype(np.int64)
+        if self.alpha == 1:
+            r = np.power(float(self.n), u)
+        else:
+            e = 1 - self.alpha
+            r = np.power((np.power(float(self.n), e) - 1) * u + 1, 1 / e)
+        return np.minimum(r.astype(np.int64) - 1, self.n - 1).clip(0)
+
+    def __call__(self, rng, size):
+        return (self.ranks(rng, size) * self.mul + self.offset) % self.n
+
+
+def write_pairs(f, rows, cols):
+    if len(rows) > 0:
+        pd.DataFrame({"x": rows, "y": cols}).to_csv(f, sep="\t", header=False, index=False)
+
+
+def sample_counts(rng, mean, size, max_count=None):
+    counts = 1 + rng.poisson(max(mean - 1, 0), size)
+    if max_count is not None:
+        counts = np.minimum(counts, max_count)
+    return counts
+
+
+def generate(data_path, dataset, n_user, n_item, n_bundle,
+             ui_per_user=50, ub_per_user=10, bundle_size=8, max_bundle_size=100,
+             item_alpha=1.1, bundle_alpha=1.1, user_alpha=0.,
+             split="cold", tune_ratio=0.1, test_ratio=0.2,
+             chunk_size=100000, seed=2025):
+    """
+    write a synthetic dataset in the datasets/ format, streamed chunk by chunk
+    user_item.txt, bundle_item.txt, user_bundle_{train,tune,test}.txt, {dataset}_data_size.txt
+    """
+    path = f"{data_path}/{dataset}"
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    items = PowerLaw(n_item, item_alpha, rng)
+    bundles = PowerLaw(n_bundle, bundle_alpha, rng)
+    users = PowerLaw(n_user, user_alpha, rng)
+    # cold split: bundle ids are assigned to train/tune/test as a whole
+    bundle_split = PowerLaw(n_bundle, 0., rng)
+    n_edges = {"user_item": 0, "bundle_item": 0, "user_bundle_train": 0, "user_bundle_tune": 0, "user_bundle_test": 0}
+
+    with open(f"{path}/bundle_item.txt", "w") as f:
+        for start in range(0, n_bundle, chunk_size):
+            bids = np.arange(start, min(start + chunk_size, n_bundle))
+            sizes = sample_counts(rng, bundle_size, len(bids), max_bundle_size)
+            rows = np.repeat(bids, sizes)
+            write_pairs(f, rows, items(rng, len(rows)))
+            n_edges["bundle_item"] += len(rows)
+
+    with open(f"{path}/user_item.txt", "w") as f:
+        for start in range(0, n_user, chunk_size):
+            n_rows = min(chunk_size, n_user - start)
+            rows = np.sort(users(rng, int(n_rows * ui_per_user)))
+            write_pairs(f, rows, items(rng, len(rows)))
+            n_edges["user_item"] += len(rows)
+
+    ub_files = {task: open(f"{path}/user_bundle_{task}.txt", "w") for task in ["train", "tune", "test"]}
+    try:
+        for start in range(0, n_user, chunk_size):
+            n_rows = min(chunk_size, n_user - start)
+            rows = np.sort(users(rng, int(n_rows * ub_per_user)))
+            cols = bundles(rng, len(rows))
+            if split == "cold":
+                # fixed random position of each bundle id in [0, n_bundle)
+                pos = (cols * bundle_split.mul + bundle_split.offset) % n_bundle / n_bundle
+            else:
+                pos = rng.random(len(rows))
+            tasks = {"test": pos < test_ratio,
+                     "tune": (pos >= test_ratio) & (pos < test_ratio + tune_ratio),
+                     "train": pos >= test_ratio + tune_ratio}
+            for task, mask in tasks.items():
+                write_pairs(ub_files[task], rows[mask], cols[mask])
+                n_edges[f"user_bundle_{task}"] += int(mask.sum())
+    finally:
+        for f in ub_files.values():
+            f.close()
+
+    with open(f"{path}/{dataset}_data_size.txt", "w") as f:
+        f.write(f"{n_user}\t{n_bundle}\t{n_item}\n")
+    return n_edges
+
+
+def main():
+    args = get_args()
+    n_edges = generate(args.data_path, args.dataset, args.n_user, args.n_item, args.n_bundle,
+                       args.ui_per_user, args.ub_per_user, args.bundle_size, args.max_bundle_size,
+                       args.item_alpha, args.bundle_alpha, args.user_alpha,
+                       args.split, args.tune_ratio, args.test_ratio,
+                       args.chunk_size, args.seed)
+    print(f"DATASET: {args.data_path}/{args.dataset}")
+    for name, n in n_edges.items():
+        print(f"{name}: {n}")
+
+
+if __name__ == "__main__":
+    main()
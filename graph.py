@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+
+_GRAPHS = {}
+
+
+def get_pairs(file_path):
+    # pandas only when a dataset is actually read, it is heavy to import
+    import pandas as pd
+    xy = pd.read_csv(file_path, sep="\t", names=["x", "y"])
+    xy = xy.to_numpy()
+    return xy
+
+
+def get_size(file_path):
+    with open(file_path) as f:
+        nu, nb, ni = [int(n) for n in f.readline().split("\t")[:3]]
+    return nu, nb, ni
+
+
+def read_pairs(file_path):
+    """
+    get_pairs, missing or empty interaction files give no pairs
+    """
+    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+        print(f"WARNING: {file_path} not found, using an empty graph")
+        return np.zeros((0, 2), dtype=np.int64)
+    return get_pairs(file_path)
+
+
+def binarize(graph):
+    graph = graph.tocsr()
+    graph.data = np.ones_like(graph.data)
+    return graph
+
+
+def list2csr_sp_graph(list_index, shape, repeat=False):
+    """
+    list indices to scipy.sparse csr (float32)
+    repeat: keep the number of duplicate pairs as edge weight, else 0/1
+    """
+    sp_graph = sp.csr_matrix(
+        (np.ones(list_index.shape[0], dtype=np.float32), (list_index[:, 0], list_index[:, 1])),
+        shape=shape
+    )
+    # csr construction sums duplicate pairs
+    if not repeat:
+        sp_graph = binarize(sp_graph)
+    return sp_graph
+
+
+def load_graph(file_path, shape, repeat=False):
+    """
+    read_pairs -> list2csr_sp_graph, ids must fit the dataset size (see config.resolve_conf)
+    """
+    pairs = read_pairs(file_path)
+    if len(pairs) > 0 and (pairs.min() < 0 or pairs[:, 0].max() >= shape[0] or pairs[:, 1].max() >= shape[1]):
+        raise ValueError(f"{file_path}: ids up to {pairs.max(axis=0).tolist()} do not fit the data size {shape}")
+    return list2csr_sp_graph(pairs, shape, repeat)
+
+
+def csr_sp_graph2list(graph):
+    graph = graph.tocoo()
+    indices = np.array([graph.row, graph.col]).T
+    return indices
+
+
+class Graphs:
+    '''
+    every CSR view of one dataset, read in a single pass and shared by
+    TrainData / TestData / RankData (see get_graphs)
+    '''
+    def __init__(self, conf):
+        self.num_user = conf["n_user"]
+        self.num_item = conf["n_item"]
+        self.num_bundle = conf["n_bundle"]
+        self.repeat = conf["load_repeat"]
+        path = f"{conf['data_path']}/{conf['dataset']}"
+
+        self.ui_graph = load_graph(f"{path}/user_item.txt", (self.num_user, self.num_item), self.repeat)
+        self.bi_graph = load_graph(f"{path}/bundle_item.txt", (self.num_bundle, self.num_item), self.repeat)
+        self.ub_graphs = {task: load_graph(f"{path}/user_bundle_{task}.txt", (self.num_user, self.num_bundle), self.repeat)
+                          for task in ["train", "tune", "test"]}
+        self.ubi_graphs = {}
+        self._uibi_graph = None
+
+    def ub_graph(self, task="train"):
+        return self.ub_graphs[task]
+
+    def ubi_graph(self, task="train"):
+        """
+        user -> bundle -> item product, computed once per split
+        """
+        if task not in self.ubi_graphs:
+            ubi_graph = self.ub_graphs[task] @ self.bi_graph
+            self.ubi_graphs[task] = ubi_graph if self.repeat else binarize(ubi_graph)
+        return self.ubi_graphs[task]
+
+    @property
+    def uibi_graph(self):
+        if self._uibi_graph is None:
+            uibi_graph = self.ui_graph + self.ubi_graph("train")
+            self._uibi_graph = uibi_graph if self.repeat else binarize(uibi_graph)
+        return self._uibi_graph
+
+
+def get_graphs(conf):
+    key = (conf["data_path"], conf["dataset"], conf["n_user"], conf["n_item"], conf["n_bundle"], conf["load_repeat"])
+    if key not in _GRAPHS:
+        _GRAPHS[key] = Graphs(conf)
+    return _GRAPHS[key]
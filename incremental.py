@@ -0,0 +1,104 @@
+from argparse import ArgumentParser
+
+from config import conf, add_conf_args, resolve_conf
+from utils import *
+
+import jax
+import jax.numpy as jnp
+import optax
+from flax import linen as nn
+from model import Net
+from flax.training import train_state
+from main import train, save_cold_checkpoint, quantize_params
+
+
+def get_args():
+    argp = add_conf_args(ArgumentParser())
+    argp.add_argument("--device_id", type=int, default=0)
+    argp.add_argument("--delta_ui", type=str, default=None, help="new user-item pairs, same format as user_item.txt")
+    argp.add_argument("--delta_ub", type=str, default=None, help="new user-bundle pairs, same format as user_bundle_train.txt")
+    args = argp.parse_args()
+    return args
+
+
+def get_delta_pairs(file_path):
+    if file_path is None:
+        return np.zeros((0, 2), dtype=np.int64)
+    return get_pairs(file_path)
+
+
+def grow_user_emb(params, n_user, key):
+    """
+    append freshly initialised rows to Net.user_emb for users unseen by the checkpoint
+    """
+    user_emb = params["params"]["user_emb"]
+    n_old, n_dim = user_emb.shape
+    if n_user <= n_old:
+        return params
+    new_rows = nn.initializers.xavier_uniform()(key, (n_user, n_dim))[n_old:]
+    params["params"]["user_emb"] = jnp.concatenate([user_emb, new_rows], axis=0)
+    return params
+
+
+def main():
+    """
+    Load Config, Cached Graphs & Checkpoint
+    """
+    args = get_args()
+    dataset_name = args.dataset
+    resolve_conf(args)
+    devices = jax.devices()
+    device = devices[args.device_id]
+    conf["device"] = device
+
+    rng_gen, rng_model = jax.random.split(jax.random.PRNGKey(2025))
+    np.random.seed(2025)
+
+    ckpt = f"{conf['ckpt_path']}/{dataset_name}_net.msgpack"
+    graph_cache = f"{conf['ckpt_path']}/{dataset_name}_graphs.npz"
+    train_data = TrainData(conf, graph_cache)
+    # previous incremental runs may have grown the user table
+    conf["n_user"] = train_data.num_user
+
+    params = load_checkpoint(ckpt, Net(conf).init(rng_model,
+                                                  jnp.array([0]),
+                                                  jnp.empty((1, conf["n_item"])),
+                                                  jnp.empty((1, conf["n_item"]))))
+
+    """
+    Apply Delta Interactions
+    """
+    delta_ui = get_delta_pairs(args.delta_ui)
+    delta_ub = get_delta_pairs(args.delta_ub)
+    n_user = max([conf["n_user"], delta_ui[:, 0].max(initial=-1) + 1, delta_ub[:, 0].max(initial=-1) + 1])
+    affected_uids = train_data.add_interactions(delta_ui, delta_ub, n_user)
+    print(f"NEW USERS: {n_user - conf['n_user']}, AFFECTED USERS: {len(affected_uids)}")
+    conf["n_user"] = n_user
+    params = grow_user_emb(params, n_user, rng_model)
+
+    """
+    Fine-tune on Affected Users & Save
+    """
+    model = Net(conf)
+    state = train_state.TrainState.create(apply_fn=model.apply,
+                                          params=params,
+                                          tx=optax.adam(learning_rate=1e-3))
+    noise_scheduler = DiffusionScheduler(num_train_timesteps=conf["timesteps"])
+    dataloader = DataLoader(UserSubset(train_data, affected_uids),
+                            batch_size=conf["batch_size"],
+                            shuffle=True,
+                            drop_last=False)
+    if len(affected_uids) > 0:
+        state = train(state, dataloader, noise_scheduler, conf["incr_epoch"], device, rng_gen)
+
+    save_checkpoint(ckpt, state.params)
+    # fine-tuning moved item_emb, the cold-start net pools users from it
+    save_cold_checkpoint(state.params, dataset_name)
+    if conf["quant"] != "none":
+        save_checkpoint(f"{conf['ckpt_path']}/{dataset_name}_net_int8.msgpack", quantize_params(state.params))
+    train_data.save_graphs(graph_cache)
+    print(f"CHECKPOINT: {ckpt} (n_user: {n_user})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,48 @@
+import os
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from functools import partial
 from tqdm import tqdm
 from argparse import ArgumentParser
 
-from config import conf
+from config import conf, add_conf_args, resolve_conf
 from utils import *
 
 import jax
 import jax.numpy as jnp
 import optax
 from flax import linen as nn
-from model import Net
+from model import Net, AdaptiveRanking, PropagationEngine, quantize
 from flax.training import train_state
-from diffusers import DDPMScheduler
+from jax.experimental import sparse
 from utils import DiffusionScheduler
+from profiler import prof
+import aot
 
-TOTAL_TIMESTEPS = conf["timesteps"]
 INF = 1e8
+# one (possibly ahead-of-time compiled) masked top-k per k, see aot.jit
+TOP_K_JIT = {}
+# jitted samplers per (model, scheduler, n_sample), repeated inference() calls reuse their executables
+SAMPLE_JIT = {}
 
 
 def get_args():
-    argp = ArgumentParser()
+    argp = add_conf_args(ArgumentParser())
     argp.add_argument("--device_id", type=int, default=0)
-    argp.add_argument("--dataset", type=str, default="clothing")
-    argp.add_argument("--data_path", type=str, default="datasets")
+    argp.add_argument("--log_dir", type=str, default="logs", help="structured per-run profile log")
+    argp.add_argument("--trace_dir", type=str, default=None, help="jax.profiler trace output")
+    argp.add_argument("--trace_steps", type=str, default=None, help="global train steps to trace, start:end")
+    argp.add_argument("--ranker_ckpt", type=str, default=None, help="AdaptiveRanking checkpoint, enables two-stage evaluation")
     args = argp.parse_args()
     return args
 
 
-def cal_metrics(
-        all_gen_buns_batch, 
-        ub_mask_graph_batch, 
-        ub_mat, bi_mat,
-        topk
-        ):
-    
-    recall_cnt, pre_cnt, ndcg_cnt, cnt = 0, 0, 0, 0
-    pred_score = all_gen_buns_batch @ bi_mat.T
-    ub_mask_graph_batch = ub_mask_graph_batch.todense()
-
-    score = pred_score + ub_mask_graph_batch * -INF
-    bs = score.shape[0]
-    _, col_ids = jax.lax.top_k(score, k=topk)
+def topk_metrics(col_ids, ub_mat, topk):
+    """
+    col_ids: [bs, topk] recommended bundle ids, ub_mat: scipy [bs, n_bundle] ground truth
+    """
+    bs = col_ids.shape[0]
     row_ids = jnp.broadcast_to(jnp.arange(0, bs).reshape(-1, 1), (bs, topk))
     hit = ub_mat[row_ids, col_ids].todense()
 
@@ -73,98 +76,460 @@ def cal_metrics(
     return recall_cnt.sum(), pre_cnt.sum(), ndcg_cnt.sum()
 
 
-def train_step(state, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle):
-    def mse_loss_fn(params, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle):
-        logits = state.apply_fn(params, uids, prob_iids, noisy_prob_iids_bundle)
-        loss = jnp.mean((logits - prob_iids)**2)
-        return loss, {"loss": loss}
+def masked_top_k(pred_score, ub_mask, topk):
+    return jax.lax.top_k(pred_score + ub_mask * -INF, k=topk)
+
+
+def top_k_jit(topk):
+    if topk not in TOP_K_JIT:
+        TOP_K_JIT[topk] = aot.jit(partial(masked_top_k, topk=topk), f"top_k{topk}")
+    return TOP_K_JIT[topk]
+
 
-    aux, grads = jax.value_and_grad(mse_loss_fn, has_aux=True)(state.params, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle)
+def cal_metrics(
+        all_gen_buns_batch, 
+        ub_mask_graph_batch, 
+        ub_mat, bi_mat,
+        topk
+        ):
+    
+    with prof.timer("eval/score"):
+        pred_score = np.asarray(all_gen_buns_batch @ bi_mat.T, dtype=np.float32)
+        ub_mask_graph_batch = np.asarray(ub_mask_graph_batch.todense(), dtype=np.float32)
+    with prof.timer("eval/top_k"):
+        _, col_ids = top_k_jit(topk)(pred_score, ub_mask_graph_batch)
+        col_ids.block_until_ready()
+    with prof.timer("eval/metrics"):
+        return topk_metrics(col_ids, ub_mat, topk)
+
+
+def candidate_score(all_gen_buns_batch, cand_ids, bi_items, bi_weights):
+    """
+    project generated items onto candidate bundles only: [bs, n_candidate], same as all_gen_buns_batch @ bi_mat.T
+    bi_items / bi_weights: padded bundle -> item table (padded with n_item) & its bi_graph values (see csr2padded)
+    """
+    gen = jnp.concatenate([all_gen_buns_batch, jnp.zeros((all_gen_buns_batch.shape[0], 1))], axis=1)
+    cand_items = bi_items[cand_ids] # [bs, n_candidate, max_bundle_len]
+    row_ids = jnp.arange(0, gen.shape[0]).reshape(-1, 1, 1)
+    return (gen[row_ids, cand_items] * bi_weights[cand_ids]).sum(axis=-1)
+
+
+def cal_metrics_candidates(
+        all_gen_buns_batch,
+        cand_ids,
+        ub_mat, bi_items, bi_weights,
+        topk
+        ):
+    score = candidate_score(all_gen_buns_batch, cand_ids, bi_items, bi_weights)
+    _, cand_col_ids = jax.lax.top_k(score, k=topk)
+    col_ids = jnp.take_along_axis(cand_ids, cand_col_ids, axis=1)
+    return topk_metrics(col_ids, ub_mat, topk)
+
+
+def train_step(state, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle, pool_iids=None):
+    """
+    pool_iids: the users' TrainData.pool_rows, only needed (and used) when conf["cold_align"] > 0
+    """
+    def mse_loss_fn(params, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle, pool_iids=None):
+        logits = state.apply_fn(params, uids, prob_iids, noisy_prob_iids_bundle)
+        mse_loss = jnp.mean((logits - prob_iids)**2)
+        if not conf["cold_align"]:
+            return mse_loss, {"loss": mse_loss, "mse": mse_loss}
+        # opt-in cold-start user pooling (serves cold_start.py), one extra matmul per step
+        align_loss = state.apply_fn(params, uids, pool_iids, method=Net.align_loss)
+        loss = mse_loss + conf["cold_align"] * align_loss
+        return loss, {"loss": loss, "mse": mse_loss, "align": align_loss}
+
+    assert pool_iids is not None or not conf["cold_align"], "cold_align needs the users' pool_iids"
+    batch = (uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle) + (() if pool_iids is None else (pool_iids,))
+    aux, grads = accumulate_grads(mse_loss_fn, state.params, batch, conf["micro_batch"])
     state = state.apply_gradients(grads=grads)
-    loss, aux_dict = aux
-    return state, loss, aux_dict
+    _, aux_dict = aux
+    # the logged training loss is the denoising mse, comparable whatever cold_align is
+    return state, aux_dict["mse"], aux_dict
+
 
+def cold_params(params):
+    """
+    params for cold-start serving: user_emb table reduced to a single placeholder row (see cold_start.py)
+    """
+    params = jax.tree_util.tree_map(lambda x: x, params)
+    params["params"]["user_emb"] = jnp.zeros((1, params["params"]["user_emb"].shape[1]))
+    return params
 
-def train(state, dataloader, noise_scheduler, epochs, device, key):
+
+def save_cold_checkpoint(params, dataset_name):
+    """
+    {dataset}_net_cold for cold_start.py, only written when pool_user was trained (conf["cold_align"] > 0):
+    without alignment its item_emb is still the init, so any earlier file is removed rather than left stale
+    """
+    path = f"{conf['ckpt_path']}/{dataset_name}_net_cold.msgpack"
+    if conf["cold_align"]:
+        save_checkpoint(path, cold_params(params))
+    else:
+        if os.path.exists(path):
+            os.remove(path)
+        print(f"CHECKPOINT: no {path}, cold-start serving needs --cold_align > 0")
+
+
+def quantize_params(params):
+    """
+    params for Net(conf, quant="int8" / "int8_bf16"): int8 enc & mlp.lin kernels (one scale per output column)
+    and user_emb (one scale per user), the rest stays fp32
+    """
+    params = jax.tree_util.tree_map(lambda x: x, params)
+    net = params["params"]
+    for layer in [net["enc"], net["mlp"]["lin"]]:
+        layer["kernel"], layer["scale"] = quantize(layer["kernel"], axis=0)
+    net["user_emb"], net["user_emb_scale"] = quantize(net["user_emb"], axis=1)
+    return params
+
+
+def train(state, dataloader, noise_scheduler, epochs, device, key, validate=None):
+    """
+    validate: params -> metrics (see make_validator), run every conf["val_interval"] epochs;
+    stops after conf["patience"] validations without a better NDCG and returns the best params
+    """
     print("TRAINING")
+    train_step_jit = aot.jit(train_step, "train_step", device)
+    train_start = time.perf_counter()
+    val_metric = "NDCG@%i" % conf["val_topk"]
+    # (val_metric, epoch, params)
+    best = None
+    stop = {}
 
     for epoch in range(epochs):
+        epoch_start = time.perf_counter()
         pbar = tqdm(dataloader)
-        for uids, prob_iids, prob_iids_bundle in pbar:
-            uids = jnp.array(uids, dtype=jnp.int32)
-            prob_iids = jnp.array(prob_iids, dtype=jnp.float32)
-            prob_iids_bundle = jnp.array(prob_iids_bundle, jnp.float32)
-
-            randkey, timekey, key = jax.random.split(key, num=3)
-            noise = jax.random.normal(randkey, shape=prob_iids_bundle.shape)
-            timesteps = jax.random.randint(timekey, (prob_iids_bundle.shape[0],), minval=0, maxval=TOTAL_TIMESTEPS-1)
-
-            noisy_prob_iids_bundle = noise_scheduler.add_noise(prob_iids_bundle, noise, timesteps)
-            state, loss, aux_dict = jax.jit(train_step, device=device)(state, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle)
+        for uids, prob_iids, prob_iids_bundle in prof.iter(pbar, "train/collate"):
+            prof.step()
+            with prof.timer("train/to_device"):
+                pool_iids = jnp.array(dataloader.dataset.pool_rows(uids), jnp.float32) if conf["cold_align"] else None
+                uids = jnp.array(uids, dtype=jnp.int32)
+                prob_iids = jnp.array(prob_iids, dtype=jnp.float32)
+                prob_iids_bundle = jnp.array(prob_iids_bundle, jnp.float32)
+
+            with prof.timer("train/noise"):
+                randkey, timekey, key = jax.random.split(key, num=3)
+                noise = jax.random.normal(randkey, shape=prob_iids_bundle.shape)
+                timesteps = jax.random.randint(timekey, (prob_iids_bundle.shape[0],), minval=0, maxval=conf["timesteps"]-1)
+
+                noisy_prob_iids_bundle = noise_scheduler.add_noise(prob_iids_bundle, noise, timesteps)
+                noisy_prob_iids_bundle.block_until_ready()
+            stage = "train/compile" if prof.new_shape("train_step", uids, prob_iids) else "train/step"
+            with prof.timer(stage):
+                state, loss, aux_dict = train_step_jit(state, uids, prob_iids, noisy_prob_iids_bundle, prob_iids_bundle, pool_iids)
+                loss.block_until_ready()
+            prof.count("train/samples", uids.shape[0])
             pbar.set_description("epoch: %i loss: %.4f" % (epoch, loss))
+        prof.log("epoch", epoch=epoch, wall_time=time.perf_counter() - epoch_start, loss=float(loss))
+
+        if validate is None or conf["val_interval"] <= 0 or (epoch + 1) % conf["val_interval"] != 0:
+            continue
+        with prof.timer("train/validate"):
+            metrics = validate(state.params)
+        prof.log("validation", epoch=epoch, **metrics)
+        print("VALIDATION epoch %i: %s" % (epoch, " ".join("%s %.6f" % (k, v) for k, v in metrics.items())))
+        if best is None or metrics[val_metric] > best[0]:
+            best = (metrics[val_metric], epoch, state.params)
+        elif conf["patience"] > 0 and epoch - best[1] >= conf["patience"] * conf["val_interval"]:
+            # the remaining epochs would have taken about as long as the ones so far
+            epoch_time = (time.perf_counter() - train_start) / (epoch + 1)
+            stop = {"stop_epoch": epoch, "epochs_skipped": epochs - epoch - 1,
+                    "wall_saved": epoch_time * (epochs - epoch - 1)}
+            print("EARLY STOP at epoch %i, %i epochs / ~%.1fs saved" % (epoch, stop["epochs_skipped"], stop["wall_saved"]))
+            break
+
+    if best is not None:
+        print("BEST EPOCH: %i %s %.6f" % (best[1], val_metric, best[0]))
+        state = state.replace(params=best[2])
+        stop.update({"best_epoch": best[1], "best_" + val_metric: best[0]})
+    prof.summary("train", time.perf_counter() - train_start, "train/samples", **stop)
     return state
 
 
+def sample_step(apply_fn, noise_scheduler, params, uids, prob_iids, post_prob_iids_bundle, t):
+    """
+    one denoising step: model prediction, then the scheduler update
+    """
+    model_output = apply_fn(params, uids, prob_iids, post_prob_iids_bundle)
+    return noise_scheduler.step(model_output, t, post_prob_iids_bundle)
+
+
+def ensemble_sample_step(apply_fn, noise_scheduler, params, uids, prob_iids, post_prob_iids_bundle, t):
+    """
+    sample_step vmapped over a leading sample axis of post_prob_iids_bundle [n_sample, bs, n_item],
+    the user conditioning (uids, prob_iids) is shared by every sample
+    """
+    step = partial(sample_step, apply_fn, noise_scheduler, params, uids, prob_iids)
+    return jax.vmap(step, in_axes=(0, None))(post_prob_iids_bundle, t)
+
+
+def reduce_samples(samples):
+    """
+    [n_sample, bs, n_item] -> [bs, n_item], the average score: bundle scores are linear in it,
+    so this equals averaging the bundle scores of the samples
+    """
+    return samples.mean(axis=0)
+
+
+def sample_jit(model, noise_scheduler, n_sample):
+    """
+    (denoising step, sample reduction or None) of inference(), compiled once per model & scheduler
+    """
+    key = (id(model), id(noise_scheduler), n_sample)
+    if key not in SAMPLE_JIT:
+        if n_sample > 1:
+            step = aot.jit(partial(ensemble_sample_step, model.apply, noise_scheduler), "ensemble_sample_step")
+            reduce = jax.jit(reduce_samples)
+        else:
+            step, reduce = aot.jit(partial(sample_step, model.apply, noise_scheduler), "sample_step"), None
+        # model & scheduler are kept alive with their entry, so their ids are not reused
+        SAMPLE_JIT[key] = (step, reduce, model, noise_scheduler)
+    return SAMPLE_JIT[key][:2]
+
+
 def inference(model, state, test_dataloader, noise_scheduler, key, n_item):
+    """
+    conf["n_sample"] > 1: denoise that many noise draws per user in one batched call per step,
+    averaged by reduce_samples
+    """
     #TODO (bt-nghia): fix inference loop over timesteps
     print("INFERENCE")
+    n_sample = conf["n_sample"]
+    sample_step_jit, reduce_jit = sample_jit(model, noise_scheduler, n_sample)
+    infer_start = time.perf_counter()
     all_genbundles = []
-    for test_data in test_dataloader:
-        key, rand_key = jax.random.split(key)
-        uids, prob_iids = test_data
-        uids = jnp.array(uids, dtype=jnp.int32)
-        prob_iids = jnp.array(prob_iids, jnp.float32)
-        noisy_prob_iids_bundle = jax.random.normal(rand_key, shape=(uids.shape[0], n_item))
-
-        post_prob_iids_bundle = noisy_prob_iids_bundle
-        for i, t in enumerate(noise_scheduler.timesteps):
-            model_output = model.apply(state.params, uids, prob_iids, post_prob_iids_bundle)
-            post_prob_iids_bundle = noise_scheduler.step(model_output, t, post_prob_iids_bundle)
+    for test_data in prof.iter(test_dataloader, "inference/collate"):
+        with prof.timer("inference/to_device"):
+            key, rand_key = jax.random.split(key)
+            uids, prob_iids = test_data
+            uids = jnp.array(uids, dtype=jnp.int32)
+            prob_iids = jnp.array(prob_iids, jnp.float32)
+            shape = (uids.shape[0], n_item) if n_sample == 1 else (n_sample, uids.shape[0], n_item)
+            noisy_prob_iids_bundle = jax.random.normal(rand_key, shape=shape)
+
+        with prof.timer("inference/denoise"):
+            post_prob_iids_bundle = noisy_prob_iids_bundle
+            for i, t in enumerate(noise_scheduler.timesteps):
+                post_prob_iids_bundle = sample_step_jit(state.params, uids, prob_iids, post_prob_iids_bundle, t)
+            if n_sample > 1:
+                post_prob_iids_bundle = reduce_jit(post_prob_iids_bundle)
+            post_prob_iids_bundle.block_until_ready()
 
         all_genbundles.append(post_prob_iids_bundle)
+        prof.count("inference/users", uids.shape[0])
     all_genbundles = np.concatenate(all_genbundles, axis=0)
+    prof.summary("inference", time.perf_counter() - infer_start, "inference/users", "users_per_sec")
     return all_genbundles
 
 
+def validation_step(apply_fn, noise_scheduler, topk, params, uids, prob_iids, ub_mask, ub_truth, bi_graph, key):
+    """
+    sample (fori_loop over the scheduler timesteps) & score a fixed user subset in one program:
+    mean Recall / NDCG@topk, same definitions as topk_metrics
+    """
+    def body(i, post_prob_iids_bundle):
+        return sample_step(apply_fn, noise_scheduler, params, uids, prob_iids, post_prob_iids_bundle, noise_scheduler.timesteps[i])
+
+    gen = jax.random.normal(key, prob_iids.shape)
+    gen = jax.lax.fori_loop(0, len(noise_scheduler.timesteps), body, gen)
+    score = (bi_graph @ gen.T).T - ub_mask * INF
+    _, col_ids = jax.lax.top_k(score, k=topk)
+    hit = jnp.take_along_axis(ub_truth, col_ids, axis=1)
+    num_pos = ub_truth.sum(axis=1)
+    discount = 1 / jnp.log2(jnp.arange(2, topk+2))
+    idcg = jnp.cumsum(discount)[jnp.clip(num_pos.astype(jnp.int32), 1, topk) - 1]
+    return {"Recall@%i" % topk: jnp.mean(hit.sum(axis=1) / (num_pos + 1e-8)),
+            "NDCG@%i" % topk: jnp.mean((hit * discount).sum(axis=1) / idcg)}
+
+
+def make_validator(model, train_data, tune_data, key):
+    """
+    params -> metrics on up to conf["val_users"] tune users, fixed subset & noise so epochs compare
+    None when the tune split has no users
+    """
+    uids = tune_data.test_uid
+    if len(uids) == 0 or conf["val_interval"] <= 0:
+        print("VALIDATION: off (no tune users or val_interval 0)")
+        return None
+    uids = np.sort(np.random.default_rng(2025).choice(uids, min(conf["val_users"], len(uids)), replace=False))
+    prob_iids = jnp.array(train_data.ui_graph[uids].toarray(), dtype=jnp.float32)
+    ub_mask = jnp.array(train_data.ub_graph[uids].toarray(), dtype=jnp.float32)
+    ub_truth = jnp.array(tune_data.ub_graph[uids].toarray(), dtype=jnp.float32)
+    bi_graph = sparse.BCOO.from_scipy_sparse(train_data.bi_graph)
+    uids = jnp.array(uids, dtype=jnp.int32)
+
+    sample_scheduler = DiffusionScheduler(num_train_timesteps=conf["sample_steps"] or conf["timesteps"])
+    step = aot.jit(partial(validation_step, model.apply, sample_scheduler, conf["val_topk"]), "validation_step")
+    print(f"VALIDATION: {len(uids)} tune users every {conf['val_interval']} epochs")
+
+    def validate(params):
+        return {k: float(v) for k, v in step(params, uids, prob_iids, ub_mask, ub_truth, bi_graph, key).items()}
+    return validate
+
+
+EVAL_TOPKS = [1, 2, 3, 5, 10, 20, 40, 50]
+# per eval worker process: the bundle -> item matrix, sent once by the pool initializer,
+# & the generations, mapped from the parent's shared memory
+EVAL_WORKER = {}
+
+
+def eval_sums(all_gen_buns, ub_mask_graph, ub_mat, bi_mat, batch_size):
+    """
+    metric sums of a contiguous range of test users, one (recall, precision, ndcg) per batch & topk
+    all_gen_buns / ub_mask_graph / ub_mat: rows of those users, the range starts on a batch boundary
+    returns {topk: [(r_cnt, p_cnt, n_cnt), ...]} in batch order
+    """
+    sums = {topk: [] for topk in EVAL_TOPKS}
+    for start in range(0, all_gen_buns.shape[0], batch_size):
+        end = start + batch_size
+        with prof.timer("eval/slice"):
+            all_gen_buns_batch = all_gen_buns[start:end]
+            ub_mask_graph_batch = ub_mask_graph[start:end]
+            ub_mat_batch = ub_mat[start:end]
+        for topk in EVAL_TOPKS:
+            sums[topk].append(cal_metrics(all_gen_buns_batch, ub_mask_graph_batch, ub_mat_batch, bi_mat, topk))
+    return sums
+
+
+def init_eval_worker(gen_name, gen_shape, gen_dtype, bi_mat, worker_conf):
+    conf.update(worker_conf)
+    # host-side work, the workers never claim the accelerator of the parent process
+    jax.config.update("jax_platforms", "cpu")
+    aot.enable_compile_cache(conf["compile_cache"])
+    EVAL_WORKER["bi_mat"] = bi_mat
+    EVAL_WORKER["shm"] = shared_memory.SharedMemory(name=gen_name)
+    EVAL_WORKER["all_gen_buns"] = np.ndarray(gen_shape, dtype=gen_dtype, buffer=EVAL_WORKER["shm"].buf)
+
+
+def eval_shard(shard):
+    """
+    sums of the rows [start, end), with the stage timers they took in this worker
+    """
+    start, end, ub_mask_graph, ub_mat, batch_size = shard
+    prof.reset()
+    sums = eval_sums(EVAL_WORKER["all_gen_buns"][start:end], ub_mask_graph, ub_mat, EVAL_WORKER["bi_mat"], batch_size)
+    return sums, dict(prof.timers), dict(prof.calls)
+
+
 def eval(conf, train_data, test_data, all_gen_buns):
-    nu, nb, ni = conf["n_user"], conf["n_bundle"], conf["n_item"]
+    """
+    conf["eval_workers"] > 1: test users split into contiguous, batch aligned ranges over that many processes,
+    the per batch sums are reduced in the single-process order, so the metrics are bit-identical
+    """
     batch_size = conf["batch_size"]
-    ui_mat = train_data.ui_graph
     bi_mat = train_data.bi_graph
-    ub_mask_graph = train_data.ub_graph
-    ub_mat = test_data.ub_graph
+    uids_test = test_data.test_uid
+    with prof.timer("eval/slice"):
+        ub_mask_graph = train_data.ub_graph[uids_test]
+        ub_mat = test_data.ub_graph[uids_test]
+    eval_start = time.perf_counter()
+
+    n_batch = -(-len(uids_test) // batch_size)
+    n_workers = min(conf["eval_workers"], n_batch)
+    # a pool worker (e.g. sweep.py) may not start processes of its own
+    if n_workers <= 1 or mp.current_process().daemon:
+        sums = eval_sums(all_gen_buns, ub_mask_graph, ub_mat, bi_mat, batch_size)
+    else:
+        bounds = [b[0] * batch_size for b in np.array_split(np.arange(n_batch), n_workers)] + [len(uids_test)]
+        # only the sparse user rows are pickled, the dense generations are shared
+        shards = [(start, end, ub_mask_graph[start:end], ub_mat[start:end], batch_size)
+                  for start, end in zip(bounds[:-1], bounds[1:])]
+        worker_conf = {k: v for k, v in conf.items() if k != "device"}
+        shm = shared_memory.SharedMemory(create=True, size=max(all_gen_buns.nbytes, 1))
+        try:
+            shared = np.ndarray(all_gen_buns.shape, dtype=all_gen_buns.dtype, buffer=shm.buf)
+            shared[:] = all_gen_buns
+            del shared
+            initargs = (shm.name, all_gen_buns.shape, all_gen_buns.dtype, bi_mat, worker_conf)
+            # spawn: this process has already started the jax backend, fork is not safe
+            ctx = mp.get_context("spawn")
+            with ctx.Pool(n_workers, initializer=init_eval_worker, initargs=initargs) as pool:
+                shard_sums = pool.map(eval_shard, shards)
+        finally:
+            shm.close()
+            shm.unlink()
+        for _, timers, calls in shard_sums:
+            prof.merge(timers, calls)
+        sums = {topk: [s for shard, _, _ in shard_sums for s in shard[topk]] for topk in EVAL_TOPKS}
+
+    metrics = {}
+    for topk in EVAL_TOPKS:
+        recall_cnt = 0
+        pre_cnt = 0
+        ndcg_cnt = 0
+        for r_cnt, p_cnt, n_cnt in sums[topk]:
+            recall_cnt+=r_cnt
+            pre_cnt+=p_cnt
+            ndcg_cnt+=n_cnt
 
+        metrics["Recall@%i" % topk] = float(recall_cnt / len(uids_test))
+        metrics["Precision@%i" % topk] = float(pre_cnt / len(uids_test))
+        metrics["NDCG@%i" % topk] = float(ndcg_cnt / len(uids_test))
+        print("Recall@%i: %s" %(topk, recall_cnt / len(uids_test)))
+        print("Precision@%i: %s" %(topk, pre_cnt / len(uids_test)))
+        print("NDCG@%i: %s" %(topk, ndcg_cnt / len(uids_test)))
+    prof.count("eval/users", len(uids_test))
+    prof.summary("eval", time.perf_counter() - eval_start, "eval/users", "users_per_sec")
+    return metrics
+
+
+def generate_candidates(conf, train_data, test_data, ranker_ckpt):
+    """
+    top-N bundles per test user from a trained AdaptiveRanking checkpoint
+    """
+    ranker = AdaptiveRanking(conf)
+    engine = PropagationEngine(ranker, train_data.ub_graph, train_data.ui_graph, train_data.bi_graph)
+    sample_x = jnp.zeros((3, 1), dtype=jnp.int32)
+    params = ranker.init(jax.random.PRNGKey(0), sample_x, engine.graphs)
+    params = load_checkpoint(ranker_ckpt, params)
+
+    uids_test = test_data.test_uid
+    batch_size = conf["batch_size"]
+    all_cands = []
+    for start in range(0, len(uids_test), batch_size):
+        uids_test_batch = uids_test[start:start+batch_size]
+        ub_mask = train_data.ub_graph[uids_test_batch].todense()
+        all_cands.append(engine.candidates(params, jnp.array(uids_test_batch), ub_mask, conf["n_candidate"]))
+    return np.concatenate(all_cands, axis=0)
+
+
+def eval_candidates(conf, train_data, test_data, all_gen_buns, all_cands):
+    """
+    rank generated bundles over the ranker candidates only,
+    k larger than the number of candidates cannot be ranked and is skipped
+    """
+    batch_size = conf["batch_size"]
+    bi_items, bi_weights = [jnp.array(t) for t in csr2padded(train_data.bi_graph, conf["n_item"])]
+    ub_mat = test_data.ub_graph
     uids_test = test_data.test_uid
-    num_batch = int(len(uids_test) / batch_size)
-    batch_idx = np.arange(0, len(uids_test))
-    test_batch_loader = DataLoader(batch_idx, batch_size=batch_size, shuffle=False, drop_last=False)
+    metrics = {}
 
-    for topk in [1, 2, 3, 5, 10, 20, 40, 50]:
+    for topk in [k for k in EVAL_TOPKS if k <= all_cands.shape[1]]:
         recall_cnt = 0
         pre_cnt = 0
         ndcg_cnt = 0
 
-        for batch in test_batch_loader:
-            start=batch[0]
-            end=batch[-1]
-
-            uids_test_batch = uids_test[start:end+1]
-            ub_mask_graph_batch = ub_mask_graph[uids_test_batch]
-            # all_gen_buns_batch = all_gen_buns[uids_test_batch]
-            all_gen_buns_batch = all_gen_buns[start:end+1]
-            
-            r_cnt, p_cnt, n_cnt = cal_metrics(all_gen_buns_batch,
-                                              ub_mask_graph_batch, 
-                                              ub_mat[uids_test_batch],
-                                              bi_mat,
-                                              topk)
+        for start in range(0, len(uids_test), batch_size):
+            end = start + batch_size
+            r_cnt, p_cnt, n_cnt = cal_metrics_candidates(all_gen_buns[start:end],
+                                                         all_cands[start:end],
+                                                         ub_mat[uids_test[start:end]],
+                                                         bi_items,
+                                                         bi_weights,
+                                                         topk)
             recall_cnt+=r_cnt
             pre_cnt+=p_cnt
             ndcg_cnt+=n_cnt
 
+        metrics["Recall@%i" % topk] = float(recall_cnt / len(uids_test))
+        metrics["Precision@%i" % topk] = float(pre_cnt / len(uids_test))
+        metrics["NDCG@%i" % topk] = float(ndcg_cnt / len(uids_test))
         print("Recall@%i: %s" %(topk, recall_cnt / len(uids_test)))
         print("Precision@%i: %s" %(topk, pre_cnt / len(uids_test)))
         print("NDCG@%i: %s" %(topk, ndcg_cnt / len(uids_test)))
+    return metrics
 
 
 def main():
@@ -173,12 +538,7 @@ def main():
     """
     args = get_args()
     dataset_name = args.dataset
-    conf["dataset"] = args.dataset
-    conf["data_path"] = args.data_path
-    nu, nb, ni = get_size(f"{conf['data_path']}/{dataset_name}/{dataset_name}_data_size.txt")
-    conf["n_user"] = nu
-    conf["n_item"] = ni
-    conf["n_bundle"] = nb
+    conf_source = resolve_conf(args)
     devices = jax.devices()
     device = devices[args.device_id]
     conf["device"] = device
@@ -186,11 +546,13 @@ def main():
     rng_infer, rng_gen, rng_model = jax.random.split(jax.random.PRNGKey(2025), num=3)
     np.random.seed(2025)
     print(conf)
+    prof.start(conf, args.log_dir, args.trace_dir, args.trace_steps, conf_source)
 
     """
     Construct Training/Validating/Testing Data
     """
     train_data = TrainData(conf)        
+    tune_data = TestData(conf, "tune")
     test_data = TestData(conf, "test")
     """
     Main Model & Optimizer, Train State
@@ -209,7 +571,7 @@ def main():
     state = train_state.TrainState.create(apply_fn=model.apply,
                                           params=params,
                                           tx=optimizer)
-    noise_scheduler = DiffusionScheduler(num_train_timesteps=TOTAL_TIMESTEPS)
+    noise_scheduler = DiffusionScheduler(num_train_timesteps=conf["timesteps"])
 
     dataloader = DataLoader(train_data,
                             batch_size=conf["batch_size"],
@@ -225,12 +587,27 @@ def main():
     """
     Training & Save checkpoint
     """
-    state = train(state, dataloader, noise_scheduler, conf["epoch"], device, rng_gen)
+    validate = make_validator(model, train_data, tune_data, jax.random.fold_in(rng_infer, 1))
+    state = train(state, dataloader, noise_scheduler, conf["epoch"], device, rng_gen, validate)
+    save_checkpoint(f"{conf['ckpt_path']}/{dataset_name}_net.msgpack", state.params)
+    save_cold_checkpoint(state.params, dataset_name)
+    train_data.save_graphs(f"{conf['ckpt_path']}/{dataset_name}_graphs.npz")
+    if conf["quant"] != "none":
+        model = Net(conf, quant=conf["quant"])
+        state = state.replace(apply_fn=model.apply, params=quantize_params(state.params))
+        save_checkpoint(f"{conf['ckpt_path']}/{dataset_name}_net_int8.msgpack", state.params)
     """
     Generate & Evaluate
     """
-    generated_bundles_test = inference(model, state, test_dataloader, noise_scheduler, rng_infer, conf["n_item"])
-    eval(conf, train_data, test_data, generated_bundles_test)
+    sample_scheduler = DiffusionScheduler(num_train_timesteps=conf["sample_steps"] or conf["timesteps"])
+    generated_bundles_test = inference(model, state, test_dataloader, sample_scheduler, rng_infer, conf["n_item"])
+    if args.ranker_ckpt is None:
+        eval(conf, train_data, test_data, generated_bundles_test)
+    else:
+        candidates_test = generate_candidates(conf, train_data, test_data, args.ranker_ckpt)
+        eval_candidates(conf, train_data, test_data, generated_bundles_test, candidates_test)
+
+    prof.close()
 
 
 if __name__ == "__main__":
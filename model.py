@@ -1,3 +1,4 @@
+import jax
 from flax import linen as nn
 import jax.numpy as jnp
 import numpy as np
@@ -6,6 +7,21 @@ from jax.experimental import sparse
 
 
 INF = 1e8
+# Net(quant=...): int8 weights of the n_item-wide layers & user_emb, for inference only (see main.quantize_params)
+# "int8": fp32 compute, "int8_bf16": bf16 compute with fp32 accumulation
+QUANT_MODES = ["none", "int8", "int8_bf16"]
+# conf["remat"]: jax.checkpoint policy of Net.denoise (enc + PredLayer, the n_item-wide activations), "none" keeps them
+REMAT_POLICIES = ["none", "nothing_saveable", "dots_saveable", "dots_with_no_batch_dims_saveable"]
+
+
+def quantize(w, axis):
+    """
+    symmetric int8 with one fp32 scale per channel, axis: the reduced (input) axis
+    returns (int8 values, scale) with w ~= values * scale
+    """
+    scale = jnp.abs(w).max(axis=axis, keepdims=True) / 127
+    scale = jnp.where(scale == 0, 1.0, scale)
+    return jnp.round(w / scale).astype(jnp.int8), scale
 
 
 def normalize(x, p=2, dim=1, eps=1e-12):
@@ -126,14 +142,40 @@ class EncoderLayer(nn.Module):
         return out
     
 
+class QDense(nn.Module):
+    '''
+    nn.Dense with an int8 kernel and a per output channel scale, params from main.quantize_params
+    the scale is applied to the matmul output, the kernel is only widened to the compute dtype
+    '''
+    features: int
+    dtype: jnp.dtype = jnp.float32
+
+    @nn.compact
+    def __call__(self, X):
+        kernel = self.param("kernel", nn.initializers.zeros, (X.shape[-1], self.features), jnp.int8)
+        scale = self.param("scale", nn.initializers.ones, (1, self.features))
+        bias = self.param("bias", nn.initializers.zeros, (self.features,))
+        out = jax.lax.dot(X.astype(self.dtype), kernel.astype(self.dtype), preferred_element_type=jnp.float32)
+        return out * scale + bias
+
+
+def dense(features, quant):
+    """
+    nn.Dense, or QDense for a quantised Net
+    """
+    if quant == "none":
+        return nn.Dense(features, kernel_init=nn.initializers.xavier_uniform(), bias_init=nn.initializers.zeros)
+    assert quant in QUANT_MODES, f"unknown quant mode {quant}"
+    return QDense(features, jnp.bfloat16 if quant == "int8_bf16" else jnp.float32)
+
+
 class PredLayer(nn.Module):
     conf: dict
+    quant: str = "none"
 
     def setup(self):
         self.n_item = self.conf["n_item"]
-        self.lin = nn.Dense(self.n_item,
-                            kernel_init=nn.initializers.xavier_uniform(),
-                            bias_init=nn.initializers.zeros)
+        self.lin = dense(self.n_item, self.quant)
 
     def __call__(self, X, residual_feat):
         out = self.lin(X) + residual_feat
@@ -141,14 +183,40 @@ class PredLayer(nn.Module):
         return logits
     
 
+def get_propagate_graph(ub_graph, ui_graph, bi_graph):
+    """
+    build the normalised bipartite propagation operators once (BCSR)
+    """
+    # float32 once, at construction: the normalisation keeps the dtype
+    # [[uu, ub], [bu, bb]]: [(u+b) x (u+b)]
+    ub_propagate_graph = sp.bmat([[sp.coo_matrix((ub_graph.shape[0], ub_graph.shape[0])), ub_graph],
+                                  [ub_graph.T, sp.coo_matrix((ub_graph.shape[1], ub_graph.shape[1]))]], dtype=np.float32)
+    ub_propagate_graph = laplace_norm(ub_propagate_graph).tocsr()
+    # [[uu, ui], [iu, ii]]: [(u+i) x (u+i)]
+    ui_propagate_graph = sp.bmat([[sp.coo_matrix((ui_graph.shape[0], ui_graph.shape[0])), ui_graph],
+                                  [ui_graph.T, sp.coo_matrix((ui_graph.shape[1], ui_graph.shape[1]))]], dtype=np.float32)
+    ui_propagate_graph = laplace_norm(ui_propagate_graph).tocsr()
+    # [bi]: [bxi]
+    bi_graph = bi_graph.astype(np.float32, copy=False)
+    bi_propagate_graph = (sp.diags(1 / (bi_graph.sum(axis=1).A.ravel() + 1e-8)) @ bi_graph).tocsr()
+    return (sparse.BCSR.from_scipy_sparse(ub_propagate_graph),
+            sparse.BCSR.from_scipy_sparse(ui_propagate_graph),
+            sparse.BCSR.from_scipy_sparse(bi_propagate_graph))
+
+
+def rank_score(u_feats, b_feats, uid):
+    u1, u2 = [i[uid] for i in u_feats]
+    b1, b2 = b_feats
+    score = u1 @ b1.T + u2 @ b2.T
+    return score
+
+
 class AdaptiveRanking(nn.Module):
     '''
     same architecture with minor differences as CrossCBR and CoHEAT 
+    graphs: (ub_prop_graph, ui_prop_graph, bi_prop_graph) from get_propagate_graph
     '''
     conf: dict
-    ub_graph: sp.coo_matrix
-    ui_graph: sp.coo_matrix
-    bi_graph: sp.coo_matrix
 
     def setup(self):
         self.user_emb = self.param('user_emb', 
@@ -160,24 +228,7 @@ class AdaptiveRanking(nn.Module):
         self.bundle_emb = self.param('bundle_emb',
                                      init_fn=nn.initializers.xavier_uniform(), 
                                      shape=(self.conf["n_bundle"], self.conf["n_dim"]))
-        self.ub_prop_graph, self.ui_prop_graph, self.bi_prop_graph = self.get_propagate_graph()
-
-    def get_propagate_graph(self):
-        # [[uu, ub], [bu, bb]]: [(u+b) x (u+b)]
-        ub_propagate_graph = sp.bmat([[sp.coo_matrix((self.ub_graph.shape[0], self.ub_graph.shape[0])), self.ub_graph],
-                                      [self.ub_graph.T, sp.coo_matrix((self.ub_graph.shape[1], self.ub_graph.shape[1]))]])
-        ub_propagate_graph = sparse.BCOO.from_scipy_sparse(laplace_norm(ub_propagate_graph))
-        # [[uu, ui], [iu, ii]]: [(u+i) x (u+i)]
-        ui_propagate_graph = sp.bmat([[sp.coo_matrix((self.ui_graph.shape[0], self.ui_graph.shape[0])), self.ui_graph],
-                                      [self.ui_graph.T, sp.coo_matrix((self.ui_graph.shape[1], self.ui_graph.shape[1]))]])
-        ui_propagate_graph = sparse.BCOO.from_scipy_sparse(laplace_norm(ui_propagate_graph))
-        # [bi]: [bxi]
-        # print(self.bi_graph.sum())
-        bi_propagate_graph = sp.diags(1 / (self.bi_graph.sum(axis=1).A.ravel() + 1e-8)) @ self.bi_graph
-        bi_propagate_graph = sparse.BCOO.from_scipy_sparse(bi_propagate_graph)
-        # print(ui_propagate_graph.sum(), ub_propagate_graph.sum(), bi_propagate_graph.sum())
-        # exit()
-        return ub_propagate_graph, ui_propagate_graph, bi_propagate_graph
+        self.num_layers = self.conf["n_prop_layer"]
 
     def level_propagate(self, feat1, feat2, graph, num_layers=1):
         features = jnp.concatenate([feat1, feat2], axis=0)
@@ -192,66 +243,103 @@ class AdaptiveRanking(nn.Module):
         feat1, feat2 = jnp.split(all_features, [feat1.shape[0]], axis=0)
         return feat1, feat2
 
-    def propagate(self):
+    def propagate(self, graphs):
+        ub_prop_graph, ui_prop_graph, bi_prop_graph = graphs
         # propagate bundle level
-        u_blevel, b_blevel = self.level_propagate(self.user_emb, self.bundle_emb, self.ub_prop_graph, 1)
+        u_blevel, b_blevel = self.level_propagate(self.user_emb, self.bundle_emb, ub_prop_graph, self.num_layers)
         # propagate item level
-        u_ilevel, i_ilevel = self.level_propagate(self.user_emb, self.item_emb, self.ui_prop_graph, 1)
+        u_ilevel, i_ilevel = self.level_propagate(self.user_emb, self.item_emb, ui_prop_graph, self.num_layers)
         # mean pooling
-        b_ilevel = self.bi_prop_graph @ i_ilevel
+        b_ilevel = bi_prop_graph @ i_ilevel
         u_feats = [u_blevel, u_ilevel]
         b_feats = [b_blevel, b_ilevel]
         return u_feats, b_feats
     
     def cal_c_loss(self, pos, aug, c_temp=0.25):
+        """
+        in-batch InfoNCE: pos/aug are the two views of the same batch rows, [bs, bs] logits only
+        """
         pos = normalize(pos)
         aug = normalize(aug)
 
-        pos_score = jnp.sum(pos * aug, axis=1)
-        ttl_score = pos @ aug.T
-
-        pos_score = jnp.exp(pos_score / c_temp)
-        ttl_score = jnp.sum(jnp.exp(ttl_score) / c_temp, axis=1)
-        c_loss = -jnp.mean(jnp.log(pos_score / ttl_score))
+        pos_score = jnp.sum(pos * aug, axis=1) / c_temp
+        ttl_score = jax.nn.logsumexp(pos @ aug.T / c_temp, axis=1)
+        c_loss = -jnp.mean(pos_score - ttl_score)
         return c_loss
      
-    def __call__(self, x):
-        u_feats, b_feats = self.propagate()
+    def __call__(self, x, graphs):
+        u_feats, b_feats = self.propagate(graphs)
         '''
         x  [[uid,...], 
             [pbid,...], 
             [nbid,...]]
         '''
-        # print(x)
         uid, pbid, nbid = x[0], x[1], x[2]
         u1, u2 = [i[uid] for i in u_feats]
         b1, b2 = [i[pbid] for i in b_feats]
         b3, b4 = [i[nbid] for i in b_feats]
 
-        # u_closs = self.cal_c_loss(u_feats[0], u_feats[1])
-        # b_closs = self.cal_c_loss(b_feats[0], b_feats[1])
-        # c_loss = (u_closs + b_closs) / 2
+        u_closs = self.cal_c_loss(u1, u2, self.conf["c_temp"])
+        b_closs = self.cal_c_loss(b1, b2, self.conf["c_temp"])
+        c_loss = (u_closs + b_closs) / 2
 
         pos_score = jnp.sum(u1 * b1 + u2 * b2, axis=1)
         neg_score = jnp.sum(u1 * b3 + u2 * b4, axis=1)
         loss = -jnp.log(nn.sigmoid(pos_score - neg_score)).mean()
-        # return loss + c_loss * 0.04
-        return loss
+        return loss + c_loss * self.conf["c_lambda"]
         
-    def eval(self, x):
-        u_feats, b_feats = self.propagate()
+    def eval(self, x, graphs):
+        u_feats, b_feats = self.propagate(graphs)
         '''
         x [uid, ...]
         '''
-        uid = x
-        u1, u2 = [i[uid] for i in u_feats]
-        b1, b2 = b_feats
-        score = u1 @ b1.T + u2 @ b2.T
-        return score
+        return rank_score(u_feats, b_feats, x)
+
+
+class PropagationEngine:
+    '''
+    runs AdaptiveRanking propagation under jit over precomputed operators,
+    propagated user/bundle features are cached until params change
+    '''
+    def __init__(self, model, ub_graph, ui_graph, bi_graph):
+        self.model = model
+        self.graphs = get_propagate_graph(ub_graph, ui_graph, bi_graph)
+        self._propagate = jax.jit(lambda params, graphs: model.apply(params, graphs, method=AdaptiveRanking.propagate))
+        self._score = jax.jit(rank_score)
+        self._candidates = jax.jit(self.topk_candidates, static_argnums=(4,))
+        self._params = None
+        self._feats = None
+
+    def propagate(self, params):
+        if params is not self._params:
+            self._feats = self._propagate(params, self.graphs)
+            self._params = params
+        return self._feats
+
+    def eval(self, params, uids):
+        u_feats, b_feats = self.propagate(params)
+        return self._score(u_feats, b_feats, uids)
+
+    @staticmethod
+    def topk_candidates(u_feats, b_feats, uids, ub_mask, n_candidate):
+        score = rank_score(u_feats, b_feats, uids) + ub_mask * -INF
+        _, cand_ids = jax.lax.top_k(score, k=n_candidate)
+        return cand_ids
+
+    def candidates(self, params, uids, ub_mask, n_candidate):
+        """
+        top-N candidate bundles per user, ub_mask: dense [bs, n_bundle] already-seen bundles
+        """
+        u_feats, b_feats = self.propagate(params)
+        return self._candidates(u_feats, b_feats, uids, ub_mask, n_candidate)
 
 
 class Net(nn.Module):
+    '''
+    quant: one of QUANT_MODES, "none" for training
+    '''
     conf: dict
+    quant: str = "none"
 
     def setup(self):
         self.n_users = self.conf["n_user"]
@@ -259,19 +347,58 @@ class Net(nn.Module):
         self.n_bundles = self.conf["n_bundle"]
         self.hidden_dim = self.conf["n_dim"]
 
-        self.user_emb = self.param("user_emb", 
-                                   nn.initializers.xavier_uniform(),
-                                   (self.n_users, self.hidden_dim))
+        if self.quant == "none":
+            self.user_emb = self.param("user_emb", 
+                                       nn.initializers.xavier_uniform(),
+                                       (self.n_users, self.hidden_dim))
+        else:
+            # one scale per user row
+            self.user_emb = self.param("user_emb", nn.initializers.zeros, (self.n_users, self.hidden_dim), jnp.int8)
+            self.user_emb_scale = self.param("user_emb_scale", nn.initializers.ones, (self.n_users, 1))
 
         self.item_emb = self.param("item_emb",
                                    nn.initializers.xavier_uniform(),
                                    (self.n_items, self.hidden_dim))
         
         self.encoder = [EncoderLayer(self.conf) for _ in range(self.conf["n_layer"])]
-        self.mlp = PredLayer(self.conf)
-        self.enc = nn.Dense(self.hidden_dim,
-                            kernel_init=nn.initializers.xavier_uniform(),
-                            bias_init=nn.initializers.zeros)
+        self.mlp = PredLayer(self.conf, self.quant)
+        self.enc = dense(self.hidden_dim, self.quant)
+
+    def denoise(self, users_feat, prob_iids, prob_iids_bundle):
+        prob_enc = self.enc(prob_iids_bundle)
+        in_feat = jnp.concat([users_feat, prob_enc], axis=1)
+        out_feat = self.mlp(in_feat, prob_iids)
+        return out_feat
+
+    def remat_denoise(self, users_feat, prob_iids, prob_iids_bundle):
+        """
+        denoise, recomputed in the backward pass under the conf["remat"] policy
+        """
+        policy = self.conf.get("remat", "none")
+        if policy == "none":
+            return self.denoise(users_feat, prob_iids, prob_iids_bundle)
+        assert policy in REMAT_POLICIES, f"unknown remat policy {policy}"
+        return nn.remat(Net.denoise, policy=getattr(jax.checkpoint_policies, policy))(self, users_feat, prob_iids, prob_iids_bundle)
+
+    def user_feat(self, uids):
+        if self.quant == "none":
+            return self.user_emb[uids]
+        return self.user_emb[uids] * self.user_emb_scale[uids]
+
+    def pool_user(self, pool_iids):
+        """
+        user representation from every item the user touched (ui + train bundle items, see TrainData.pool_rows):
+        mean of their item embeddings
+        """
+        cnt = pool_iids.sum(axis=1, keepdims=True)
+        return (pool_iids @ self.item_emb) / (cnt + 1e-8)
+
+    def align_loss(self, uids, pool_iids):
+        """
+        teach pool_user to reproduce the trained user_emb rows (user_emb itself gets no gradient)
+        """
+        target = jax.lax.stop_gradient(self.user_feat(uids))
+        return jnp.mean((self.pool_user(pool_iids) - target)**2)
 
     def __call__(self, uids, prob_iids, prob_iids_bundle):
         """
@@ -279,11 +406,12 @@ class Net(nn.Module):
         prob_iids: user's item probability
         prob_iids_bundle: sampled item in interacted bundle probability (noise while inference)
         """
-        # print(uids)
-        users_feat = self.user_emb[uids]
-        prob_enc = self.enc(prob_iids_bundle)
-        in_feat = jnp.concat([users_feat, prob_enc], axis=1)
-        out_feat = self.mlp(in_feat, prob_iids)
-        return out_feat
-        # return prob_iids
-    
+        users_feat = self.user_feat(uids)
+        return self.remat_denoise(users_feat, prob_iids, prob_iids_bundle)
+
+    def cold_call(self, prob_iids, pool_iids, prob_iids_bundle):
+        """
+        same as __call__ for users without a user_emb row
+        """
+        users_feat = self.pool_user(pool_iids)
+        return self.remat_denoise(users_feat, prob_iids, prob_iids_bundle)
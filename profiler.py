@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import resource
+from collections import defaultdict
+from contextlib import contextmanager
+
+import jax
+
+
+class Profiler:
+    '''
+    named stage timers, throughput counters & peak memory, one jsonl log per run
+    '''
+    def __init__(self):
+        self.timers = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.shapes = set()
+        self.log_file = None
+        self.trace_dir = None
+        self.trace_steps = None
+        self.tracing = False
+        self.global_step = 0
+
+    def reset(self):
+        """
+        clear timers & counters, e.g. between the trials of one sweep worker
+        """
+        self.timers.clear()
+        self.calls.clear()
+        self.counters.clear()
+        self.shapes.clear()
+
+    def start(self, conf, log_dir="logs", trace_dir=None, trace_steps=None, conf_source=None):
+        """
+        trace_steps: "start:end" global train steps to capture with jax.profiler
+        conf_source: where each config value came from (see config.resolve_conf)
+        """
+        os.makedirs(log_dir, exist_ok=True)
+        run_name = "%s_%s_%s" % (conf.get("dataset"), conf.get("model_name", "run"), time.strftime("%Y%m%d-%H%M%S"))
+        self.log_file = open(f"{log_dir}/{run_name}.jsonl", "a")
+        self.trace_dir = trace_dir
+        if trace_steps is not None:
+            self.trace_steps = tuple(int(s) for s in trace_steps.split(":"))
+        self.log("run", conf={k: str(v) for k, v in conf.items()}, conf_source=conf_source, devices=[str(d) for d in jax.devices()])
+        print(f"RUN LOG: {self.log_file.name}")
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        yield
+        self.timers[name] += time.perf_counter() - start
+        self.calls[name] += 1
+
+    def iter(self, iterable, name):
+        """
+        time each next() of a (data loader) iterator, e.g. batch collation
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(name):
+                batch = next(iterator, None)
+            if batch is None:
+                return
+            yield batch
+
+    def new_shape(self, name, *arrays):
+        """
+        True on the first call of a jitted stage with these shapes (compile + run)
+        """
+        key = (name,) + tuple(x.shape for x in arrays)
+        if key in self.shapes:
+            return False
+        self.shapes.add(key)
+        return True
+
+    def merge(self, timers, calls):
+        """
+        add the timers of another process, e.g. an eval worker
+        """
+        for name, t in timers.items():
+            self.timers[name] += t
+        for name, n in calls.items():
+            self.calls[name] += n
+
+    def count(self, name, n):
+        self.counters[name] += int(n)
+
+    def step(self):
+        """
+        advance the global train step, start/stop the jax.profiler trace window
+        """
+        if self.trace_dir is not None and self.trace_steps is not None:
+            if self.global_step == self.trace_steps[0] and not self.tracing:
+                jax.profiler.start_trace(self.trace_dir)
+                self.tracing = True
+            elif self.global_step == self.trace_steps[1] and self.tracing:
+                jax.profiler.stop_trace()
+                self.tracing = False
+        self.global_step += 1
+
+    @staticmethod
+    def memory():
+        # ru_maxrss is in KB on linux
+        mem = {"host_peak_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+        for device in jax.local_devices():
+            stats = device.memory_stats() or {}
+            if "peak_bytes_in_use" in stats:
+                mem[f"{device}_peak_bytes"] = stats["peak_bytes_in_use"]
+        return mem
+
+    def log(self, event, **kwargs):
+        if self.log_file is None:
+            return
+        record = {"event": event, "time": time.time()}
+        record.update(kwargs)
+        self.log_file.write(json.dumps(record) + "\n")
+        self.log_file.flush()
+
+    def summary(self, stage, wall_time, samples_key=None, rate_name="samples_per_sec", **kwargs):
+        """
+        log & print the timers of one stage ("train", "inference", "eval")
+        """
+        timers = {k: round(v, 4) for k, v in self.timers.items() if k.startswith(stage + "/")}
+        calls = {k: v for k, v in self.calls.items() if k.startswith(stage + "/")}
+        record = {"stage": stage, "wall_time": wall_time, "timers": timers, "calls": calls}
+        if samples_key is not None:
+            record[samples_key] = self.counters[samples_key]
+            record[rate_name] = self.counters[samples_key] / max(wall_time, 1e-8)
+        record.update(kwargs)
+        record.update(self.memory())
+        self.log("summary", **record)
+        print("PROFILE %s: wall %.2fs | %s" % (stage, wall_time, " | ".join("%s %.2fs" % (k, v) for k, v in timers.items())))
+        if rate_name in record:
+            print("PROFILE %s: %s %.1f" % (stage, rate_name, record[rate_name]))
+
+    def close(self):
+        if self.tracing:
+            jax.profiler.stop_trace()
+            self.tracing = False
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+
+prof = Profiler()
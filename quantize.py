@@ -0,0 +1,65 @@
+import time
+from argparse import ArgumentParser
+
+from config import conf, add_conf_args, resolve_conf
+from utils import *
+
+import jax
+import jax.numpy as jnp
+from model import QUANT_MODES
+from flax.training import train_state
+from main import inference, eval, quantize_params
+
+
+METRICS = ["Recall@20", "NDCG@20", "Recall@50", "NDCG@50"]
+
+
+def get_args():
+    argp = add_conf_args(ArgumentParser())
+    argp.add_argument("--modes", type=str, nargs="+", default=QUANT_MODES[1:], help="quant modes to compare with fp32")
+    args = argp.parse_args()
+    return args
+
+
+def n_bytes(params):
+    return sum(x.size * x.dtype.itemsize for x in jax.tree_util.tree_leaves(params))
+
+
+def main():
+    """
+    Post-training quantisation of a trained Net: write {dataset}_net_int8, load it back the way serving does,
+    and report its accuracy & sampling speed against the fp32 checkpoint
+    """
+    args = get_args()
+    resolve_conf(args)
+    train_data = TrainData(conf)
+    test_data = TestData(conf, "test")
+    test_dataloader = DataLoader(test_data, batch_size=conf["batch_size"], shuffle=False, drop_last=False)
+    sample_scheduler = DiffusionScheduler(num_train_timesteps=conf["sample_steps"] or conf["timesteps"])
+
+    model, params = load_net(conf)
+    save_checkpoint(f"{conf['ckpt_path']}/{conf['dataset']}_net_int8.msgpack", quantize_params(params))
+
+    results = {}
+    for quant in ["none"] + args.modes:
+        model, params = load_net(conf, quant)
+        state = train_state.TrainState(step=0, apply_fn=model.apply, params=params, tx=None, opt_state=None)
+        # first pass compiles
+        inference(model, state, test_dataloader, sample_scheduler, jax.random.PRNGKey(2025), conf["n_item"])
+        start = time.perf_counter()
+        generated = inference(model, state, test_dataloader, sample_scheduler, jax.random.PRNGKey(2025), conf["n_item"])
+        infer_time = time.perf_counter() - start
+        metrics = eval(conf, train_data, test_data, generated)
+        results[quant] = ({k: metrics[k] for k in METRICS}, n_bytes(params), infer_time)
+        del generated
+
+    print("QUANT REPORT: %s" % conf["dataset"])
+    print("%-10s %9s %8s" % ("quant", "MB", "infer(s)") + "".join(" %18s" % k for k in METRICS))
+    base = results["none"][0]
+    for quant, (metrics, size, infer_time) in results.items():
+        print("%-10s %9.2f %8.2f" % (quant, size / 2**20, infer_time)
+              + "".join(" %9.5f (%+.5f)" % (metrics[k], metrics[k] - base[k]) for k in METRICS))
+
+
+if __name__ == "__main__":
+    main()
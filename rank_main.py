@@ -0,0 +1,129 @@
+from tqdm import tqdm
+from argparse import ArgumentParser
+
+from config import conf, add_conf_args, resolve_conf
+from utils import *
+
+import jax
+import jax.numpy as jnp
+import optax
+from model import AdaptiveRanking, PropagationEngine
+from flax.training import train_state
+from main import topk_metrics
+
+
+def get_args():
+    argp = add_conf_args(ArgumentParser())
+    argp.add_argument("--device_id", type=int, default=0)
+    args = argp.parse_args()
+    return args
+
+
+def train_step(state, x, graphs):
+    def bpr_loss_fn(params, x, graphs):
+        loss = state.apply_fn(params, x, graphs)
+        return loss
+
+    loss, grads = jax.value_and_grad(bpr_loss_fn)(state.params, x, graphs)
+    state = state.apply_gradients(grads=grads)
+    return state, loss
+
+
+def train(state, dataloader, engine, epochs, device):
+    print("TRAINING RANKER")
+    train_step_jit = jax.jit(train_step, device=device)
+
+    for epoch in range(epochs):
+        pbar = tqdm(dataloader)
+        for uids, pos_bids, neg_bids in pbar:
+            x = jnp.stack([jnp.array(uids, dtype=jnp.int32),
+                           jnp.array(pos_bids, dtype=jnp.int32),
+                           jnp.array(neg_bids, dtype=jnp.int32)], axis=0)
+            state, loss = train_step_jit(state, x, engine.graphs)
+            pbar.set_description("epoch: %i loss: %.4f" % (epoch, loss))
+    return state
+
+
+def eval(conf, engine, params, train_data, test_data):
+    """
+    candidate recall of the ranker: how many test bundles survive the first stage
+    """
+    batch_size = conf["batch_size"]
+    ub_mat = test_data.ub_graph
+    uids_test = test_data.test_uid
+
+    for topk in [20, 50, conf["n_candidate"]]:
+        recall_cnt = 0
+        pre_cnt = 0
+        ndcg_cnt = 0
+
+        for start in range(0, len(uids_test), batch_size):
+            uids_test_batch = uids_test[start:start+batch_size]
+            ub_mask = train_data.ub_graph[uids_test_batch].todense()
+            col_ids = engine.candidates(params, jnp.array(uids_test_batch), ub_mask, topk)
+            r_cnt, p_cnt, n_cnt = topk_metrics(col_ids, ub_mat[uids_test_batch], topk)
+            recall_cnt+=r_cnt
+            pre_cnt+=p_cnt
+            ndcg_cnt+=n_cnt
+
+        print("Recall@%i: %s" %(topk, recall_cnt / len(uids_test)))
+        print("Precision@%i: %s" %(topk, pre_cnt / len(uids_test)))
+        print("NDCG@%i: %s" %(topk, ndcg_cnt / len(uids_test)))
+
+
+def main():
+    """
+    Load Config & Init
+    """
+    args = get_args()
+    dataset_name = args.dataset
+    resolve_conf(args)
+    devices = jax.devices()
+    device = devices[args.device_id]
+    conf["device"] = device
+
+    rng_model = jax.random.PRNGKey(2025)
+    np.random.seed(2025)
+    print(conf)
+
+    """
+    Construct Training/Testing Data
+    """
+    train_data = TrainData(conf)
+    rank_data = RankData(conf)
+    test_data = TestData(conf, "test")
+
+    """
+    Ranker & Optimizer, Train State
+    """
+    model = AdaptiveRanking(conf)
+    engine = PropagationEngine(model, train_data.ub_graph, train_data.ui_graph, train_data.bi_graph)
+    sample_x = jnp.zeros((3, 1), dtype=jnp.int32)
+    params = model.init(rng_model, sample_x, engine.graphs)
+    optimizer = optax.adam(learning_rate=conf["rank_lr"])
+
+    state = train_state.TrainState.create(apply_fn=model.apply,
+                                          params=params,
+                                          tx=optimizer)
+
+    dataloader = DataLoader(rank_data,
+                            batch_size=conf["rank_batch_size"],
+                            shuffle=True,
+                            drop_last=False)
+
+    """
+    Training & Save checkpoint
+    """
+    state = train(state, dataloader, engine, conf["rank_epoch"], device)
+    ckpt = f"{conf['ckpt_path']}/{dataset_name}_ranker.msgpack"
+    save_checkpoint(ckpt, state.params)
+    print(f"RANKER CHECKPOINT: {ckpt}")
+
+    """
+    Candidate Recall
+    """
+    eval(conf, engine, state.params, train_data, test_data)
+
+
+if __name__ == "__main__":
+    main()
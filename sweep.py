@@ -0,0 +1,132 @@
+import time
+import itertools
+import multiprocessing as mp
+from argparse import ArgumentParser
+
+from config import conf, add_conf_args, resolve_conf, cast
+from utils import *
+
+import jax
+import jax.numpy as jnp
+import optax
+from model import Net
+from flax.training import train_state
+from main import train, inference, eval
+from profiler import prof
+
+
+# knobs that do not change the shapes of the compiled train step, trials that only
+# differ in these run back to back in one worker and reuse its executables
+SHAPE_FREE_KEYS = ["epoch", "timesteps", "sample_steps"]
+METRICS = ["Recall@20", "NDCG@20", "Recall@50", "NDCG@50"]
+# per worker: one (Net, optimizer) per shape group, jit caches key on apply_fn / tx identity
+MODELS = {}
+
+
+def get_args():
+    argp = add_conf_args(ArgumentParser())
+    argp.add_argument("--grid", type=str, nargs="+", required=True,
+                      help="config values to sweep, key=v1,v2 ... e.g. n_dim=64,128 timesteps=20,100")
+    argp.add_argument("--workers", type=int, default=1, help="trial processes, spread over devices / cpu cores")
+    argp.add_argument("--out", type=str, default="sweep.csv")
+    args = argp.parse_args()
+    return args
+
+
+def parse_grid(grid):
+    """
+    ["n_dim=64,128", ...] -> list of trial overrides (cartesian product)
+    """
+    axes = {}
+    for item in grid:
+        key, values = item.split("=", 1)
+        axes[key] = [cast(key, v) for v in values.split(",")]
+    return [dict(zip(axes, values)) for values in itertools.product(*axes.values())]
+
+
+def shape_group(trial):
+    return tuple(sorted((k, v) for k, v in trial.items() if k not in SHAPE_FREE_KEYS))
+
+
+def run_trial(trial):
+    """
+    train, sample & evaluate one configuration, return its metrics and throughput
+    """
+    conf.update(trial)
+    devices = jax.devices()
+    device = devices[WORKER["index"] % len(devices)]
+    conf["device"] = device
+    prof.reset()
+    np.random.seed(2025)
+    rng_infer, rng_gen, rng_model = jax.random.split(jax.random.PRNGKey(2025), num=3)
+
+    train_data = TrainData(conf)
+    test_data = TestData(conf, "test")
+    group = shape_group(trial)
+    if group not in MODELS:
+        MODELS[group] = (Net(dict(conf)), optax.adam(learning_rate=1e-3))
+    model, optimizer = MODELS[group]
+    params = model.init(rng_model, jnp.array([0]), jnp.empty((1, conf["n_item"])), jnp.empty((1, conf["n_item"])))
+    state = train_state.TrainState.create(apply_fn=model.apply, params=params, tx=optimizer)
+    dataloader = DataLoader(train_data, batch_size=conf["batch_size"], shuffle=True, drop_last=False)
+    test_dataloader = DataLoader(test_data, batch_size=conf["batch_size"], shuffle=False, drop_last=False)
+
+    start = time.perf_counter()
+    state = train(state, dataloader, DiffusionScheduler(num_train_timesteps=conf["timesteps"]), conf["epoch"], device, rng_gen)
+    train_time = time.perf_counter() - start
+    start = time.perf_counter()
+    sample_scheduler = DiffusionScheduler(num_train_timesteps=conf["sample_steps"] or conf["timesteps"])
+    generated_bundles_test = inference(model, state, test_dataloader, sample_scheduler, rng_infer, conf["n_item"])
+    infer_time = time.perf_counter() - start
+    metrics = eval(conf, train_data, test_data, generated_bundles_test)
+
+    result = dict(trial)
+    result.update({k: metrics[k] for k in METRICS})
+    result["compile_sec"] = prof.timers["train/compile"]
+    result["train_samples_per_sec"] = prof.counters["train/samples"] / max(train_time, 1e-8)
+    result["infer_users_per_sec"] = prof.counters["inference/users"] / max(infer_time, 1e-8)
+    result["device"] = str(device)
+    return result
+
+
+def run_group(trials):
+    return [run_trial(trial) for trial in trials]
+
+
+def main():
+    """
+    Base Config & Trials
+    """
+    args = get_args()
+    resolve_conf(args)
+    trials = parse_grid(args.grid)
+    groups = {}
+    for trial in trials:
+        groups.setdefault(shape_group(trial), []).append(trial)
+    print(f"SWEEP: {len(trials)} trials in {len(groups)} shape groups, {args.workers} workers")
+
+    """
+    Parse the dataset once, forked workers share the cached graphs (see graph.get_graphs)
+    """
+    graphs = get_graphs(conf)
+    for task in ["train", "tune", "test"]:
+        graphs.ubi_graph(task)
+    graphs.uibi_graph
+
+    """
+    Run & Report
+    """
+    # fork before this process touches a jax backend
+    ctx = mp.get_context("fork")
+    with ctx.Pool(args.workers, initializer=init_worker, initargs=(ctx.Value("i", 0), args.workers)) as pool:
+        results = [r for rs in pool.imap_unordered(run_group, list(groups.values())) for r in rs]
+
+    import pandas as pd
+    table = pd.DataFrame(results).sort_values(list(trials[0].keys()))
+    table.to_csv(args.out, index=False)
+    print(table.to_string(index=False))
+    print(f"SWEEP REPORT: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,84 +1,141 @@
+import os
+import jax
 import jax.numpy as jnp
-import pandas as pd
 import numpy as np
 from config import *
-from torch.utils.data import Dataset, DataLoader
-from diffusers import DDPMScheduler
 import scipy.sparse as sp
-from jax.experimental import sparse
+from flax import serialization
+from graph import *
+from model import Net
 
 
-TOTAL_TIMESTEPS = conf["timesteps"]
 
+def csr2padded(graph, pad_value):
+    """
+    scipy.sparse csr rows to padded [n_row, max_row_len] tables:
+    column indices (padded with pad_value) & their values (padded with 0, e.g. load_repeat counts)
+    """
+    graph = graph.tocsr()
+    row_len = np.diff(graph.indptr)
+    shape = (graph.shape[0], max(row_len.max(initial=0), 1))
+    table = np.full(shape, pad_value, dtype=np.int32)
+    weights = np.zeros(shape, dtype=np.float32)
+    rows = np.repeat(np.arange(graph.shape[0]), row_len)
+    cols = np.arange(graph.nnz) - np.repeat(graph.indptr[:-1], row_len)
+    table[rows, cols] = graph.indices
+    weights[rows, cols] = graph.data
+    return table, weights
 
-def get_pairs(file_path):
-    xy = pd.read_csv(file_path, sep="\t", names=["x", "y"])
-    xy = xy.to_numpy()
-    return xy
 
+def save_checkpoint(path, params):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(serialization.to_bytes(params))
 
-def get_size(file_path):
-    nu, nb, ni = pd.read_csv(file_path, sep="\t", names=["u", "b", "i"]).to_numpy()[0]
-    return nu, nb, ni
+
+def load_checkpoint(path, params):
+    """
+    params: target pytree (e.g. from model.init) to restore into
+    """
+    with open(path, "rb") as f:
+        return serialization.from_bytes(params, f.read())
 
 
-def list2jax_sp_graph(list_index, shape):
-    values = np.ones(list_index.shape[0])
-    sp_graph = sp.coo_matrix(
-        (values, (list_index[:, 0], list_index[:, 1])),
-        shape=shape
-    )
-    jax_sp_graph = sparse.BCOO.from_scipy_sparse(sp_graph)
-    return jax_sp_graph
+def save_sp_graphs(path, **graphs):
+    """
+    scipy.sparse csr graphs -> single npz (indptr/indices/data/shape per graph)
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    arrays = {}
+    for name, graph in graphs.items():
+        arrays[f"{name}.indptr"] = graph.indptr
+        arrays[f"{name}.indices"] = graph.indices
+        arrays[f"{name}.data"] = graph.data
+        arrays[f"{name}.shape"] = np.array(graph.shape)
+    np.savez(path, **arrays)
 
 
-def list2graph(list_index, shape):
-    graph = np.zeros(shape)
-    for i in list_index:
-        graph[i[0], i[1]] = 1
-        # important
-        # graph[i[0], i[1]] += 1 # load repeat or not
-    return graph
+def load_sp_graphs(path):
+    arrays = np.load(path)
+    names = {k.rsplit(".", 1)[0] for k in arrays.files}
+    return {name: sp.csr_matrix((arrays[f"{name}.data"], arrays[f"{name}.indices"], arrays[f"{name}.indptr"]),
+                                shape=tuple(arrays[f"{name}.shape"]))
+            for name in names}
 
 
-def list2csr_sp_graph(list_index, shape):
+def collate(samples):
     """
-    list indices to scipy.sparse csr
+    list of samples (tuples of arrays / scalars) -> tuple of stacked numpy arrays
     """
-    sp_graph = sp.coo_matrix(
-        (np.ones(list_index.shape[0]), (list_index[:, 0], list_index[:, 1])),
-        shape=shape
-    ).tocsr()
-    return sp_graph > 0
+    if isinstance(samples[0], tuple):
+        return tuple(np.stack(field) for field in zip(*samples))
+    return np.stack(samples)
 
 
-def graph2list(graph):
-    idx = np.stack(graph.nonzero(), axis=0)
-    idx = idx.T  # [[row, col], ...]
-    return idx
+class Dataset:
+    '''
+    map-style dataset: __getitem__ / __len__, __getitems__ returns a whole collated batch
+    (torch.utils.data.Dataset without torch)
+    '''
+    def __getitems__(self, indices):
+        return collate([self[i] for i in indices])
 
 
-def jax_sp_graph2list(graph):
-    idx = graph.indices
-    idx = idx.T
-    return idx
+class DataLoader:
+    '''
+    numpy batches of a Dataset (or array), shuffled with np.random
+    (torch.utils.data.DataLoader without torch and its worker processes)
+    '''
+    def __init__(self, dataset, batch_size=1, shuffle=False, drop_last=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
 
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return -(-len(self.dataset) // self.batch_size)
+
+    def __iter__(self):
+        n = len(self.dataset)
+        order = np.random.permutation(n) if self.shuffle else np.arange(n)
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            indices = order[start:start + self.batch_size]
+            if isinstance(self.dataset, np.ndarray):
+                yield self.dataset[indices]
+            elif hasattr(self.dataset, "__getitems__"):
+                yield self.dataset.__getitems__(indices)
+            else:
+                yield collate([self.dataset[i] for i in indices])
+
+
+def accumulate_grads(loss_fn, params, batch, micro_batch):
+    """
+    jax.value_and_grad(loss_fn, has_aux=True) of a per-row mean loss over batch (arrays sharing dim 0),
+    run micro_batch rows at a time: scan over the full micro batches, one extra pass for the remainder,
+    each weighted by its share of rows, i.e. the same loss & gradients as the whole batch
+    """
+    grad_fn = jax.value_and_grad(loss_fn, has_aux=True)
+    bs = batch[0].shape[0]
+    if micro_batch <= 0 or micro_batch >= bs:
+        return grad_fn(params, *batch)
 
-def csr_sp_graph2list(graph):
-    graph = graph.tocoo()
-    indices = np.array([graph.row, graph.col]).T
-    return indices
+    n_micro, rest = divmod(bs, micro_batch)
+    micro_batches = [x[:n_micro * micro_batch].reshape((n_micro, micro_batch) + x.shape[1:]) for x in batch]
 
+    def body(acc, micro):
+        out = grad_fn(params, *micro)
+        return jax.tree_util.tree_map(jnp.add, acc, out), None
 
-def make_sp_diag_mat(n):
-    ids = np.arange(0, n)
-    vals = np.ones(n, dtype=float)
-    diag_mat = sp.coo_matrix(
-        (vals, (ids, ids)),
-        shape=(n, n)
-    )
-    jax_sp_diag_mat =  sparse.BCOO.from_scipy_sparse(diag_mat)
-    return jax_sp_diag_mat
+    zeros = jax.tree_util.tree_map(lambda x: jnp.zeros(x.shape, x.dtype),
+                                   jax.eval_shape(grad_fn, params, *[x[0] for x in micro_batches]))
+    acc, _ = jax.lax.scan(body, zeros, micro_batches)
+    acc = jax.tree_util.tree_map(lambda x: x * (micro_batch / bs), acc)
+    if rest:
+        out = grad_fn(params, *[x[n_micro * micro_batch:] for x in batch])
+        acc = jax.tree_util.tree_map(lambda x, y: x + y * (rest / bs), acc, out)
+    return acc
 
 
 class DiffusionScheduler:
@@ -87,11 +144,13 @@ class DiffusionScheduler:
     '''
     def __init__(
             self,
-            num_train_timesteps=TOTAL_TIMESTEPS,
+            num_train_timesteps=None,
             beta_start=0,
             beta_end=1
     ):
         super().__init__()
+        # resolved at construction, conf["timesteps"] may be overridden after import
+        num_train_timesteps = num_train_timesteps or conf["timesteps"]
         self.betas = jnp.linspace(beta_start, beta_end, num_train_timesteps)
         self.alphas = 1 - self.betas
         self.alphas_cumprod = jnp.cumprod(self.alphas, axis=0)
@@ -120,7 +179,7 @@ class DiffusionScheduler:
 '''
 Generation Dataloader
 '''
-class TestData():
+class TestData(Dataset):
     def __init__(self, conf, task="test"):
         super().__init__()
         self.conf = conf
@@ -128,22 +187,22 @@ class TestData():
         self.num_item = self.conf["n_item"]
         self.num_bundle = self.conf["n_bundle"]
 
-        self.ui_pairs = get_pairs(f"{self.conf['data_path']}/{self.conf['dataset']}/user_item.txt")
-        self.ub_pairs = get_pairs(f"{self.conf['data_path']}/{self.conf['dataset']}/user_bundle_{task}.txt")
-        self.bi_pairs = get_pairs(f"{self.conf['data_path']}/{self.conf['dataset']}/bundle_item.txt")
-        self.ub_mask_pairs = get_pairs(f"{self.conf['data_path']}/{self.conf['dataset']}/user_bundle_train.txt")
-
-        self.ui_graph = list2csr_sp_graph(self.ui_pairs, (self.num_user, self.num_item))
-        self.ub_graph = list2csr_sp_graph(self.ub_pairs, (self.num_user, self.num_bundle))
-        self.bi_graph = list2csr_sp_graph(self.bi_pairs, (self.num_bundle, self.num_item))
+        graphs = get_graphs(self.conf)
+        self.ui_graph = graphs.ui_graph
+        self.ub_graph = graphs.ub_graph(task)
+        self.bi_graph = graphs.bi_graph
         self.test_uid = self.ub_graph.sum(axis=1).nonzero()[0]
-        self.ub_mask_graph = list2csr_sp_graph(self.ub_mask_pairs, (self.num_user, self.num_bundle))
+        self.ub_mask_graph = graphs.ub_graph("train")
 
     def __getitem__(self, index):
         uid = self.test_uid[index]
         prob_iids = np.array(self.ui_graph[uid].todense()).reshape(-1)
         return uid, prob_iids
 
+    def __getitems__(self, indices):
+        uids = self.test_uid[indices]
+        return uids, self.ui_graph[uids].toarray()
+
     def __len__(self):
         return len(self.test_uid)
     
@@ -155,7 +214,7 @@ class TrainData(Dataset):
     item prob -> for guidance
     item (bundle) -> for denoised
     """
-    def __init__(self, conf):
+    def __init__(self, conf, graph_path=None):
         super().__init__()
         self.conf = conf
         # we use bundle id to easily link bundle to user for train and test purpose 
@@ -163,16 +222,70 @@ class TrainData(Dataset):
         self.num_item = self.conf["n_item"]
         self.num_bundle = self.conf["n_bundle"]
 
-        self.ui_pairs = get_pairs(f"{self.conf['data_path']}/{self.conf['dataset']}/user_item.txt")
-        self.ub_pairs = get_pairs(f"{self.conf['data_path']}/{self.conf['dataset']}/user_bundle_train.txt")
-        self.bi_pairs = get_pairs(f"{self.conf['data_path']}/{self.conf['dataset']}/bundle_item.txt")
-
-        self.ui_graph = list2csr_sp_graph(self.ui_pairs, (self.num_user, self.num_item))
-        self.ub_graph = list2csr_sp_graph(self.ub_pairs, (self.num_user, self.num_bundle))
-        self.bi_graph = list2csr_sp_graph(self.bi_pairs, (self.num_bundle, self.num_item))
-
-        self.uibi_graph = self.ui_graph + self.ub_graph @ self.bi_graph
         self.zeros_prob_iids = np.zeros((self.num_item,))
+        if graph_path is not None and os.path.exists(graph_path):
+            # cached (possibly incrementally updated) graphs, see save_graphs
+            self.load_graphs(graph_path)
+            return
+
+        graphs = get_graphs(self.conf)
+        self.ui_graph = graphs.ui_graph
+        self.ub_graph = graphs.ub_graph("train")
+        self.bi_graph = graphs.bi_graph
+        self.ubi_graph = graphs.ubi_graph("train")
+        self.uibi_graph = graphs.uibi_graph
+
+    def load_graphs(self, path):
+        graphs = load_sp_graphs(path)
+        self.ui_graph = graphs["ui_graph"]
+        self.ub_graph = graphs["ub_graph"]
+        self.bi_graph = graphs["bi_graph"]
+        self.ubi_graph = graphs["ubi_graph"]
+        self.uibi_graph = graphs["uibi_graph"]
+        self.num_user = self.ub_graph.shape[0]
+
+    def pool_rows(self, uids):
+        """
+        every item the users touched, ui row + items of their train bundles (what Net.pool_user averages),
+        the ui row alone is empty on datasets without user_item.txt
+        """
+        return self.uibi_graph[uids].toarray()
+
+    def save_graphs(self, path):
+        save_sp_graphs(path,
+                       ui_graph=self.ui_graph,
+                       ub_graph=self.ub_graph,
+                       bi_graph=self.bi_graph,
+                       ubi_graph=self.ubi_graph,
+                       uibi_graph=self.uibi_graph)
+
+    def add_interactions(self, ui_pairs, ub_pairs, num_user):
+        """
+        apply new user-item / user-bundle pairs to this dataset's graphs
+        num_user: may be larger than the current one for new users
+        return: ids of the users whose rows changed
+        """
+        repeat = self.conf["load_repeat"]
+        if num_user > self.num_user:
+            # graphs may be shared with other datasets (get_graphs), resize copies
+            self.ui_graph, self.ub_graph, self.ubi_graph, self.uibi_graph = [
+                sp.vstack([graph, sp.csr_matrix((num_user - self.num_user, graph.shape[1]), dtype=graph.dtype)]).tocsr()
+                for graph in [self.ui_graph, self.ub_graph, self.ubi_graph, self.uibi_graph]]
+            self.num_user = num_user
+
+        delta_ui = list2csr_sp_graph(ui_pairs, (self.num_user, self.num_item), repeat)
+        delta_ub = list2csr_sp_graph(ub_pairs, (self.num_user, self.num_bundle), repeat)
+        if not repeat:
+            # only bundles the user did not have yet contribute new items
+            delta_ub = binarize(delta_ub > self.ub_graph).astype(np.float32)
+        delta_ubi = delta_ub @ self.bi_graph
+
+        combine = (lambda x: x) if repeat else binarize
+        self.ui_graph = combine(self.ui_graph + delta_ui)
+        self.ub_graph = combine(self.ub_graph + delta_ub)
+        self.ubi_graph = combine(self.ubi_graph + delta_ubi)
+        self.uibi_graph = combine(self.uibi_graph + delta_ui + delta_ubi)
+        return np.unique(np.concatenate([ui_pairs[:, 0], ub_pairs[:, 0]]))
 
     def __getitem__(self, index):
         uid = index
@@ -185,6 +298,120 @@ class TrainData(Dataset):
             prob_iids_bundle = self.zeros_prob_iids
         return uid, prob_iids, prob_iids_bundle
 
+    def __getitems__(self, indices):
+        """
+        __getitem__ for a batch of users, one sliced row block per graph
+        """
+        uids = np.asarray(indices)
+        prob_iids = self.ui_graph[uids].toarray()
+        ub_graph = self.ub_graph[uids]
+        n_bun = np.diff(ub_graph.indptr)
+        # one uniformly drawn interacted bundle per user, users without bundles get zeros
+        pick = ub_graph.indptr[:-1] + (np.random.random(len(uids)) * n_bun).astype(np.int64)
+        bids = np.zeros(len(uids), dtype=np.int64)
+        if ub_graph.nnz > 0:
+            bids = ub_graph.indices[np.minimum(pick, ub_graph.nnz - 1)]
+        prob_iids_bundle = self.bi_graph[bids].toarray()
+        prob_iids_bundle[n_bun == 0] = 0
+        return uids, prob_iids, prob_iids_bundle
+
     def __len__(self):
         return self.num_user
-    
\ No newline at end of file
+    
+
+class RankData(Dataset):
+    """
+    BPR triples for AdaptiveRanking
+    user id, positive bundle id, negative bundle id
+    """
+    def __init__(self, conf):
+        super().__init__()
+        self.conf = conf
+        self.num_user = self.conf["n_user"]
+        self.num_bundle = self.conf["n_bundle"]
+
+        self.ub_graph = get_graphs(self.conf).ub_graph("train")
+        self.ub_pairs = csr_sp_graph2list(self.ub_graph)
+
+    def __getitem__(self, index):
+        uid, pos_bid = self.ub_pairs[index]
+        neg_bid = np.random.randint(self.num_bundle)
+        while self.ub_graph[uid, neg_bid]:
+            neg_bid = np.random.randint(self.num_bundle)
+        return uid, pos_bid, neg_bid
+
+    def __getitems__(self, indices):
+        uids, pos_bids = self.ub_pairs[indices].T
+        neg_bids = np.random.randint(self.num_bundle, size=len(uids))
+        resample = np.asarray(self.ub_graph[uids, neg_bids]).reshape(-1) > 0
+        while resample.any():
+            neg_bids[resample] = np.random.randint(self.num_bundle, size=resample.sum())
+            resample[resample] = np.asarray(self.ub_graph[uids[resample], neg_bids[resample]]).reshape(-1) > 0
+        return uids, pos_bids, neg_bids
+
+    def __len__(self):
+        return len(self.ub_pairs)
+
+
+class UserSubset(Dataset):
+    """
+    restrict a per-user dataset (TrainData) to the given user ids
+    """
+    def __init__(self, data, uids):
+        super().__init__()
+        self.data = data
+        self.uids = uids
+
+    def __getitem__(self, index):
+        return self.data[self.uids[index]]
+
+    def __getitems__(self, indices):
+        return self.data.__getitems__(self.uids[indices])
+
+    def pool_rows(self, uids):
+        # batches carry the original user ids
+        return self.data.pool_rows(uids)
+
+    def __len__(self):
+        return len(self.uids)
+
+
+# per pool worker process (sweep.py, export.py): its index, see init_worker
+WORKER = {"index": 0}
+
+
+def init_worker(counter, n_workers):
+    """
+    pool initializer: number the worker & give it an equal share of the cpu cores for XLA's thread pool
+    """
+    with counter.get_lock():
+        WORKER["index"] = counter.value
+        counter.value += 1
+    cores = sorted(os.sched_getaffinity(0))
+    share = cores[WORKER["index"]::n_workers] or cores
+    os.sched_setaffinity(0, share)
+
+
+def ckpt_n_user(conf):
+    """
+    user count of the checkpointed net: incremental.py grows it past the dataset's,
+    the {dataset}_graphs cache saved with every checkpoint holds the current one
+    """
+    path = f"{conf['ckpt_path']}/{conf['dataset']}_graphs.npz"
+    if not os.path.exists(path):
+        return conf["n_user"]
+    return int(np.load(path)["ub_graph.shape"][0])
+
+
+def load_net(conf, quant="none"):
+    """
+    Net & params from the {dataset}_net checkpoint, quant != "none": the {dataset}_net_int8 checkpoint
+    """
+    model = Net(dict(conf, n_user=ckpt_n_user(conf)), quant=quant)
+    params = jax.eval_shape(lambda: model.init(jax.random.PRNGKey(0),
+                                               jnp.zeros((1,), dtype=jnp.int32),
+                                               jnp.empty((1, conf["n_item"])),
+                                               jnp.empty((1, conf["n_item"]))))
+    suffix = "" if quant == "none" else "_int8"
+    params = load_checkpoint(f"{conf['ckpt_path']}/{conf['dataset']}_net{suffix}.msgpack", params)
+    return model, params